@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import os
+import subprocess
+import sys
+import time
+
+import reward_function
+from tests.parms import parms
+
+"""
+Performance benchmarks of the reward function and the development tools. The unit tests check only functional
+properties (e.g. the geometry of a track is not rebuilt), the timings depend on the machine and its load and are
+measured here instead. Every benchmark returns a dictionary of measured values.
+
+Usage:
+    python benchmark.py [benchmark name ...]
+
+This module is a development tool only, it is not supposed to be pasted into the AWS console.
+"""
+
+
+# Lookup of the precomputed track geometry when the environment passes a fresh waypoints list every step vs building
+# the geometry (what the lookup must be much cheaper than)
+def benchmark_track_geometry_lookup(lookups=5000, builds=200):
+    waypoints = parms.params_bowtle['waypoints']
+    reward_function.warm_up(waypoints)
+    fresh_lists = [copy.deepcopy(waypoints) for _ in range(lookups)]
+    start = time.perf_counter()
+    for fresh_list in fresh_lists:
+        reward_function.get_track_geometry(fresh_list)
+    lookup_time = (time.perf_counter() - start) / lookups
+    start = time.perf_counter()
+    for fresh_list in fresh_lists[:builds]:
+        reward_function.TrackGeometry(fresh_list)
+    build_time = (time.perf_counter() - start) / builds
+    return {"lookup_us": lookup_time * 1e6, "build_us": build_time * 1e6, "speedup": build_time / lookup_time}
+
+
+# Time of importing reward_function in a fresh interpreter (the simulator workers import it on start)
+def benchmark_import(repeat=5):
+    code = ("import time\n"
+            "start = time.perf_counter()\n"
+            "import reward_function\n"
+            "print(time.perf_counter() - start)\n")
+    source_dir = os.path.dirname(os.path.abspath(reward_function.__file__))
+    timings = [float(subprocess.check_output([sys.executable, "-S", "-c", code], cwd=source_dir).decode())
+               for _ in range(repeat)]
+    return {"import_ms": min(timings) * 1000}
+
+
+# Replay of all waypoints of both bundled tracks with one and with twenty reward variants
+def benchmark_reward_variants(variants=20):
+    from reward_equivalence import normalize_track, random_params
+    from reward_variants import MultiVariantEvaluator, RewardVariant
+    params_list = []
+    for base_params in (normalize_track(parms.params_reinvent2018), normalize_track(parms.params_bowtle)):
+        for seed in range(3):
+            for waypoint_index in range(len(base_params['waypoints'])):
+                params_list.append(random_params(base_params, waypoint_index, seed))
+    all_variants = [RewardVariant("v" + str(index), heading_weight=index / float(variants)) for index in range(variants)]
+    timings = {}
+    for name, selected in (("one", all_variants[:1]), ("all", all_variants)):
+        start = time.perf_counter()
+        MultiVariantEvaluator(selected).evaluate_all(params_list)
+        timings[name] = time.perf_counter() - start
+    return {"one_variant_us_per_step": timings["one"] / len(params_list) * 1e6,
+            "all_variants_us_per_step": timings["all"] / len(params_list) * 1e6,
+            "cost_ratio": timings["all"] / timings["one"]}
+
+
+# Decoding throughput of a trace archive (values per second) - a generated trace of long episodes written with the
+# default and with small chunks, decoded in pure Python and with NumPy when it is installed
+def benchmark_trace_archive(episodes=300, episode_steps=3000):
+    import tempfile
+    import trace_archive
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests"))
+    from test_trace_archive import generate_trace_lines
+    rows = list(trace_archive.parse_trace_log(generate_trace_lines(episodes)))
+    # Consecutive generated episodes joined into long ones (real episodes have up to thousands of steps)
+    rows = [(index // episode_steps, index % episode_steps + 1) + row[2:] for index, row in enumerate(rows)]
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "trace.dta")
+        for chunk_rows in (128, 4096):
+            trace_archive.write_archive(path, rows, chunk_rows)
+            for use_numpy in (False, True) if numpy is not None else (False,):
+                archive = trace_archive.TraceArchive(path, use_numpy=use_numpy)
+                start = time.perf_counter()
+                archive.read_all()
+                elapsed = time.perf_counter() - start
+                name = "{0}_chunk_{1}_mvalues_per_s".format("numpy" if use_numpy else "python", chunk_rows)
+                results[name] = len(rows) * len(trace_archive.COLUMNS) / elapsed / 1e6
+    return results
+
+
+# Time of one RollingFeatures.update with a short and a long window (it should not depend on the window)
+def benchmark_rolling_features(steps=20000):
+    import random
+    generator = random.Random(1)
+    rows = [(index % 500 + 1, (index % 500) * 0.2, generator.uniform(-30, 30), generator.uniform(1, 4),
+             generator.uniform(0, 20)) for index in range(steps)]
+    results = {}
+    for window in (5, 1000):
+        rolling = reward_function.RollingFeatures(window)
+        start = time.perf_counter()
+        for values in rows:
+            rolling.update(*values)
+        results["window_" + str(window) + "_us_per_update"] = (time.perf_counter() - start) / steps * 1e6
+    results["window_ratio"] = results["window_1000_us_per_update"] / results["window_5_us_per_update"]
+    return results
+
+
+BENCHMARKS = {
+    "track_geometry_lookup": benchmark_track_geometry_lookup,
+    "import": benchmark_import,
+    "reward_variants": benchmark_reward_variants,
+    "trace_archive": benchmark_trace_archive,
+    "rolling_features": benchmark_rolling_features,
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        results = BENCHMARKS[name]()
+        print(name + ": " + ", ".join("{0} {1:.4g}".format(key, value) for key, value in sorted(results.items())))
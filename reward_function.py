@@ -1,16 +1,193 @@
 # -*- coding: utf-8 -*-
 
 import math
-import traceback
 
 """
 This is the source code you cut and paste into AWS console. It consists of RewardEvaluator class that is instantiated
 by the code of the desired reward_function(). The  RewardEvaluator contains a set of elementary  "low level" functions 
  for example the distance calculation between waypoints, directions as well as higher-level functions (e.g. nearest turn 
 direction and distance) allowing you to design more complex reward logic.
+
+The module imports nothing but "math" so that every simulator worker can import it within a few milliseconds. Anything
+heavier (traceback formatting, analysis tools) is imported only at the moment it is really needed.
 """
 
 
+class TrackGeometry:
+
+    # Precomputed geometry of one circuit track. The waypoints are the same for every call on a particular circuit
+    # track, therefore the track is normalized (see preprocess_waypoints()) and segment lengths and headings are
+    # calculated only once per process and then just looked up. The tables are indexed by normalized point index,
+    # index_map translates the index of a waypoint in params['waypoints'] (as in params['closest_waypoints']) to it.
+    # Segment "i" is the part of the track between point i and point i + 1. On a closed circuit the last segment closes
+    # the circuit back to the first point. An open track (closed is False) ends in its last point - there is no
+    # closing segment, the last "segment" has zero length and continues the direction of the previous one, and the
+    # horizon walks stop there. Every real segment is longer than MIN_SEGMENT_LENGTH, so the horizon walks always
+    # terminate. removed_waypoints is the number of duplicated waypoints merged by the preprocessing (0 for a clean
+    # track).
+    def __init__(self, waypoints):
+        self.waypoints = tuple(tuple(waypoint) for waypoint in waypoints)
+        self.num_waypoints = len(self.waypoints)
+        self.points, self.index_map, self.closed = preprocess_waypoints(self.waypoints)
+        self.num_points = len(self.points)
+        self.removed_waypoints = self.num_waypoints - self.num_points
+        segment_lengths = []
+        segment_headings = []
+        for index in range(self.num_points):
+            from_point = self.points[index]
+            to_point = self.points[(index + 1) % self.num_points]
+            segment_lengths.append(math.sqrt(pow(to_point[1] - from_point[1], 2) + pow(to_point[0] - from_point[0], 2)))
+            segment_headings.append(math.degrees(math.atan2(to_point[1] - from_point[1], to_point[0] - from_point[0])))
+        if not self.closed:
+            segment_lengths[-1] = 0.0
+            segment_headings[-1] = segment_headings[-2]
+        self.segment_lengths = tuple(segment_lengths)
+        self.segment_headings = tuple(segment_headings)
+        self.track_length = sum(segment_lengths)
+        self.digest = get_track_digest(self.waypoints)
+        self.name, self.tuning = KNOWN_TRACKS.get(self.digest, (None, {}))
+        self.horizon_breakpoints = {}
+
+    # The horizon walks (see RewardEvaluator.get_optimum_speed_ratio()) start at a point and pass segments until the
+    # distance of the car to that point plus the segments passed reaches the horizon. Their result depends on the car
+    # position only through the number of segments passed, i.e. through the interval of the distance to the start
+    # point delimited by horizon - (lengths of the first k segments), k = 1, 2, ... Returns these breakpoints
+    # (ascending) for every point as a start point. They are calculated once per track, horizon and work budget.
+    def get_horizon_breakpoints(self, horizon, max_steps):
+        breakpoints = self.horizon_breakpoints.get((horizon, max_steps))
+        if breakpoints is None:
+            breakpoints = tuple(self.get_walk_breakpoints(start, horizon, max_steps)
+                                for start in range(self.num_points))
+            self.horizon_breakpoints[(horizon, max_steps)] = breakpoints
+        return breakpoints
+
+    def get_walk_breakpoints(self, start, horizon, max_steps):
+        end_index = None if self.closed else self.num_points - 1
+        breakpoints = []
+        length = 0.0
+        index = start
+        while index != end_index and len(breakpoints) <= max_steps:
+            length = length + self.segment_lengths[index % self.num_points]
+            if horizon - length <= 0 or index + 1 == end_index:  # the walk always stops here
+                break
+            breakpoints.append(horizon - length)
+            index = index + 1
+        breakpoints.reverse()
+        return tuple(breakpoints)
+
+
+# Waypoints closer to each other than this (meters) are considered to be the same point
+MIN_SEGMENT_LENGTH = 1e-6
+
+
+# Preprocessing of the raw waypoints, run once per track:
+#   - consecutive duplicated waypoints (zero-length segments) are merged into one point, a waypoint equal to the
+#     first one at the end of the list (closed loop) is dropped as well - the track wraps around anyway,
+#   - the track is considered closed when the last waypoint duplicates the first one or the gap between them is not
+#     longer than twice the longest segment.
+# The order of the waypoints is the driving direction of the car and params['closest_waypoints'] refer to it,
+# therefore the waypoints are never reordered (whatever the orientation of the circuit is).
+# Returns (points, index_map, closed) where index_map maps every raw waypoint index to its point index.
+# A duplicated waypoint maps to the point of the first waypoint of the duplicates, so the segment "starting" at it is
+# the next real segment of the track. Raises ValueError when there are less than two distinct waypoints.
+def preprocess_waypoints(waypoints):
+    points = []
+    index_map = []
+    for waypoint in waypoints:
+        if points and abs(waypoint[0] - points[-1][0]) < MIN_SEGMENT_LENGTH \
+                and abs(waypoint[1] - points[-1][1]) < MIN_SEGMENT_LENGTH:
+            index_map.append(len(points) - 1)
+        else:
+            points.append(waypoint)
+            index_map.append(len(points) - 1)
+    closing_duplicate = len(points) > 1 and abs(points[-1][0] - points[0][0]) < MIN_SEGMENT_LENGTH \
+        and abs(points[-1][1] - points[0][1]) < MIN_SEGMENT_LENGTH
+    if closing_duplicate:
+        last_index = len(points) - 1
+        points.pop()
+        index_map = [0 if point_index == last_index else point_index for point_index in index_map]
+    if len(points) < 2:
+        raise ValueError("Degenerate track, less than two distinct waypoints")
+    longest_segment = max(math.hypot(points[index + 1][0] - points[index][0], points[index + 1][1] - points[index][1])
+                          for index in range(len(points) - 1)) if len(points) > 2 else 0.0
+    closing_gap = math.hypot(points[0][0] - points[-1][0], points[0][1] - points[-1][1])
+    closed = closing_duplicate or closing_gap <= 2 * longest_segment
+    return tuple(points), tuple(index_map), closed
+
+
+# Calculates a digest identifying the circuit track by all its waypoints (rounded to millimetres). It is calculated
+# only once per track and process - when the geometry of the track is built.
+def get_track_digest(waypoints):
+    import zlib  # imported lazily, needed only once per track
+    canonical = ";".join("{0:.3f},{1:.3f}".format(waypoint[0], waypoint[1]) for waypoint in waypoints)
+    return "{0:08x}".format(zlib.crc32(canonical.encode("ascii")))
+
+
+# Registry of known circuit tracks: digest of waypoints -> (track name, tuning). Tuning is a dictionary of
+# RewardEvaluator constants overriding the class defaults on that particular track, e.g.
+# {"SAFE_HORIZON_DISTANCE": 1.0}. Any other track is still fine - its geometry is precomputed on the fly, it just has
+# no name and no tuning.
+KNOWN_TRACKS = {
+    "b3d8ccbe": ("reInvent2018", {}),
+    "ad43d7b8": ("Bowtie", {}),
+}
+
+
+def register_track(name, waypoints, **tuning):
+    KNOWN_TRACKS[get_track_digest(waypoints)] = (name, tuning)
+    clear_track_cache()
+
+
+# Forgets all precomputed geometries, e.g. after the registry of known tracks has been changed
+def clear_track_cache():
+    global _last_waypoints, _last_track_geometry
+    _track_geometry_cache.clear()
+    _last_waypoints = None
+    _last_track_geometry = None
+
+
+# Process wide cache of track geometries. Hashing all waypoints on every step would cost more than the precomputed
+# tables save, so a track is identified by a cheap fingerprint - number of waypoints plus five sampled waypoints. The
+# full list of waypoints is converted and checked only when the fingerprint is seen for the first time. The last seen
+# waypoints list is remembered as well, when the environment keeps passing the same list object no lookup is needed at
+# all. Both shortcuts assume the waypoints of a track are never modified in place (they are not by the environment).
+TRACK_GEOMETRY_CACHE_SIZE = 16
+_track_geometry_cache = {}
+_last_waypoints = None
+_last_track_geometry = None
+
+
+def get_track_fingerprint(waypoints):
+    num_waypoints = len(waypoints)
+    if num_waypoints == 0:
+        return 0,
+    return (num_waypoints, tuple(waypoints[0]), tuple(waypoints[num_waypoints // 4]),
+            tuple(waypoints[num_waypoints // 2]), tuple(waypoints[(num_waypoints * 3) // 4]), tuple(waypoints[-1]))
+
+
+def get_track_geometry(waypoints):
+    global _last_waypoints, _last_track_geometry
+    if waypoints is _last_waypoints and _last_track_geometry is not None \
+            and len(waypoints) == _last_track_geometry.num_waypoints:
+        return _last_track_geometry
+    fingerprint = get_track_fingerprint(waypoints)
+    geometry = _track_geometry_cache.get(fingerprint)
+    if geometry is None:
+        if len(_track_geometry_cache) >= TRACK_GEOMETRY_CACHE_SIZE:
+            _track_geometry_cache.clear()
+        geometry = TrackGeometry(waypoints)
+        _track_geometry_cache[fingerprint] = geometry
+    _last_waypoints = waypoints
+    _last_track_geometry = geometry
+    return geometry
+
+
+# Optional eager warm-up - call it right after the import (e.g. with waypoints of the circuit you are training on) and
+# the very first reward calculation does not pay for the geometry precomputation.
+def warm_up(waypoints):
+    return get_track_geometry(waypoints)
+
+
 class RewardEvaluator:
 
     # CALCULATION CONSTANTS - change for the performance fine tuning
@@ -46,6 +223,13 @@ class RewardEvaluator:
     PENALTY_MAX = 0.001
     REWARD_MAX = 89999  # 100000
 
+    # Expected number of steps per lap - used by the progress bonus (progress checked every 100 steps)
+    TOTAL_NUM_STEPS = 150
+
+    # Maximum number of track segments one horizon walk may pass (see get_optimum_speed_ratio()). It bounds the work
+    # per step under any input (e.g. a tiny track with a long horizon), BudgetExceeded is raised when exceeded.
+    MAX_HORIZON_STEPS = 1000
+
     # params is a set of input values provided by the DeepRacer environment. For each calculation
     # this is provided
     params = None
@@ -67,9 +251,34 @@ class RewardEvaluator:
     closest_waypoints = None
     nearest_previous_waypoint_ind = None
     nearest_next_waypoint_ind = None
+    track = None
 
     log_message = ""
 
+    # Optional LatencyGuard - when set, evaluate() runs with a time budget and returns a fallback reward on failure
+    guard = None
+    # Time budget of the running evaluation: clock function and the deadline (None means no time limit)
+    clock = None
+    deadline = None
+
+    # Optional RollingFeatures of the running episode (updated with this step) - set by reward_function() when
+    # rolling_features is enabled, to be combined in evaluate() by the user (it is not used by default)
+    rolling = None
+
+    # Bitmask of features logged by log_feature() during the last evaluation (see FEATURE_BITS), used by StepRecorder
+    features = 0
+    FEATURE_BITS = {
+        "all_wheels_on_track or is_reversed issue": 1,
+        "getCarHeadingOK": 2,
+        "getSteeringAngleOK": 4,
+        "is_in_optimized_corridor": 8,
+        "isStraightOnMaxSpeed": 16,
+        "isOptimumSpeedinCurve": 32,
+        "progressingOk": 64,
+        "reached_target": 128,
+        "fallback": 256,
+    }
+
     # method used to extract class properties (status values) from input "params"
     def init_self(self, params):
         self.all_wheels_on_track = params['all_wheels_on_track']
@@ -88,6 +297,19 @@ class RewardEvaluator:
         self.closest_waypoints = params['closest_waypoints']
         self.nearest_previous_waypoint_ind = params['closest_waypoints'][0]
         self.nearest_next_waypoint_ind = params['closest_waypoints'][1]
+        self.features = 0
+        self.track = get_track_geometry(self.waypoints)
+        if self.track.tuning:
+            self.apply_tuning(self.track.tuning)
+
+    # Applies the tuning of a known track (see KNOWN_TRACKS) to this evaluator. A constant is tuned only when the class
+    # of the evaluator still has the value of RewardEvaluator - a constant overridden by a subclass (e.g. a reward
+    # variant or a sweep configuration) is an explicit choice and takes precedence over the track tuning.
+    def apply_tuning(self, tuning):
+        evaluator_class = type(self)
+        for key, value in tuning.items():
+            if getattr(evaluator_class, key) is getattr(RewardEvaluator, key):
+                setattr(self, key, value)
 
     # RewardEvaluator Class constructor
     def __init__(self, params):
@@ -128,10 +350,8 @@ class RewardEvaluator:
     # Calculates the misalignment of the heading of the car () compared to center line of the track (defined by previous and
     # the next waypoint (the car is between them)
     def get_car_heading_error(self):  # track direction vs heading
-        next_point = self.get_way_point(self.closest_waypoints[1])
-        prev_point = self.get_way_point(self.closest_waypoints[0])
-        track_direction = math.atan2(next_point[1] - prev_point[1], next_point[0] - prev_point[0])
-        track_direction = math.degrees(track_direction)
+        track_direction = self.track.segment_headings[
+            self.track.index_map[self.closest_waypoints[0] % self.track.num_waypoints]]
         return track_direction - self.heading
 
     # Based on CarHeadingError (how much the car is misaligned with th direction of the track) and based on the "safe
@@ -141,17 +361,23 @@ class RewardEvaluator:
             return float(0.34)
         if abs(self.get_car_heading_error()) >= (self.MAX_STEERING_ANGLE * 0.75):
             return float(0.67)
-        current_position_xy = (self.x, self.y)
-        current_wp_index = self.closest_waypoints[1]
-        length = self.get_way_points_distance((self.x, self.y), self.get_way_point(current_wp_index))
-        current_track_heading = self.get_heading_between_waypoints(self.get_way_point(current_wp_index),
-                                                                   self.get_way_point(current_wp_index + 1))
+        points = self.track.points
+        segment_lengths = self.track.segment_lengths
+        num_points = self.track.num_points
+        current_wp_index = self.track.index_map[self.closest_waypoints[1] % self.track.num_waypoints]
+        horizon_start_point = points[current_wp_index]
+        length = self.get_way_points_distance((self.x, self.y), horizon_start_point)
+        current_track_heading = self.track.segment_headings[current_wp_index]
+        end_index = None if self.track.closed else num_points - 1
+        walked = 0
+        deadline = self.deadline
         while True:
-            from_point = self.get_way_point(current_wp_index)
-            to_point = self.get_way_point(current_wp_index + 1)
-            length = length + self.get_way_points_distance(from_point, to_point)
-            if length >= self.SAFE_HORIZON_DISTANCE:
-                heading_to_horizont_point = self.get_heading_between_waypoints(self.get_way_point(self.closest_waypoints[1]), to_point)
+            if current_wp_index == end_index:  # An open track ends before the horizon - nothing to slow down for
+                return float(1.0)
+            to_point = points[(current_wp_index + 1) % num_points]
+            length = length + segment_lengths[current_wp_index % num_points]
+            if length >= self.SAFE_HORIZON_DISTANCE or current_wp_index + 1 == end_index:
+                heading_to_horizont_point = self.get_heading_between_waypoints(horizon_start_point, to_point)
                 if abs(current_track_heading - heading_to_horizont_point) > (self.MAX_STEERING_ANGLE * 0.5):
                     return float(0.33)
                 elif abs(current_track_heading - heading_to_horizont_point) > (self.MAX_STEERING_ANGLE * 0.25):
@@ -159,15 +385,19 @@ class RewardEvaluator:
                 else:
                     return float(1.0)
             current_wp_index = current_wp_index + 1
+            walked = walked + 1
+            if walked > self.MAX_HORIZON_STEPS or (deadline is not None and self.clock() > deadline):
+                raise BudgetExceeded("get_optimum_speed_ratio", walked)
 
     # Calculates angle of the turn the car is right now (degrees). It is angle between previous and next segment of the
     # track (previous_waypoint - closest_waypoint and closest_waypoint - next_waypoint)
     def get_turn_angle(self):
-        current_waypoint = self.closest_waypoints[0]
-        angle_ahead = self.get_heading_between_waypoints(self.get_way_point(current_waypoint),
-                                                         self.get_way_point(current_waypoint + 1))
-        angle_behind = self.get_heading_between_waypoints(self.get_way_point(current_waypoint - 1),
-                                                          self.get_way_point(current_waypoint))
+        segment_headings = self.track.segment_headings
+        current_waypoint = self.track.index_map[self.closest_waypoints[0] % self.track.num_waypoints]
+        if current_waypoint == 0 and not self.track.closed:  # The start of an open track, there is nothing behind
+            return 0
+        angle_ahead = segment_headings[current_waypoint]
+        angle_behind = segment_headings[current_waypoint - 1]
         result = angle_ahead - angle_behind
         if angle_ahead < -90 and angle_behind > 90:
             return 360 + result
@@ -197,14 +427,22 @@ class RewardEvaluator:
     # Provides direction of the next turn in order to let you reward right position to the center line (before the left
     # turn position of the car sligthly right can be rewarded (and vice versa) - see is_in_optimized_corridor()
     def get_expected_turn_direction(self):
-        current_waypoint_index = self.closest_waypoints[1]
-        length = self.get_way_points_distance((self.x, self.y), self.get_way_point(current_waypoint_index))
+        points = self.track.points
+        segment_lengths = self.track.segment_lengths
+        num_points = self.track.num_points
+        current_waypoint_index = self.track.index_map[self.closest_waypoints[1] % self.track.num_waypoints]
+        horizon_start_point = points[current_waypoint_index]
+        length = self.get_way_points_distance((self.x, self.y), horizon_start_point)
+        end_index = None if self.track.closed else num_points - 1
+        walked = 0
+        deadline = self.deadline
         while True:
-            from_point = self.get_way_point(current_waypoint_index)
-            to_point = self.get_way_point(current_waypoint_index + 1)
-            length = length + self.get_way_points_distance(from_point, to_point)
-            if length >= self.SAFE_HORIZON_DISTANCE * 4.5:
-                result = self.get_heading_between_waypoints(self.get_way_point(self.closest_waypoints[1]), to_point)
+            if current_waypoint_index == end_index:  # An open track ends before the horizon - no turn ahead
+                return "STRAIGHT"
+            to_point = points[(current_waypoint_index + 1) % num_points]
+            length = length + segment_lengths[current_waypoint_index % num_points]
+            if length >= self.SAFE_HORIZON_DISTANCE * 4.5 or current_waypoint_index + 1 == end_index:
+                result = self.get_heading_between_waypoints(horizon_start_point, to_point)
                 if result > 2:
                     return "LEFT"
                 elif result < -2:
@@ -212,6 +450,9 @@ class RewardEvaluator:
                 else:
                     return "STRAIGHT"
             current_waypoint_index = current_waypoint_index + 1
+            walked = walked + 1
+            if walked > self.MAX_HORIZON_STEPS or (deadline is not None and self.clock() > deadline):
+                raise BudgetExceeded("get_expected_turn_direction", walked)
 
     # Based on the direction of the next turn it indicates the car is on the right side to the center line in order to
     # drive through smoothly - see get_expected_turn_direction().
@@ -257,19 +498,26 @@ class RewardEvaluator:
         else:
             return False
 
+    # Indicates the car made enough progress - evaluated every 100 steps only
+    def is_progressing_ok(self):
+        return (self.steps % 100 == 0) and self.progress > (self.steps / self.TOTAL_NUM_STEPS)
+
     # Accumulates all logging messages into one string which you may need to write to the log (uncomment line
     # self.status_to_string() in evaluate() if you want to log status and calculation outputs.
     def log_feature(self, message):
         if message is None:
             message = 'NULL'
+        self.features = self.features | self.FEATURE_BITS.get(message, 0)
         self.log_message = self.log_message + str(message) + '|'
 
     # Here you can implement your logic to calculate reward value based on input parameters (params) and use
     # implemented features (as methods above)
     def evaluate(self):
-        self.init_self(self.params)
+        if self.guard is not None:
+            self.guard.start(self)
         result_reward = float(0.001)
         try:
+            self.init_self(self.params)
             # No reward => Fatal behaviour, NOREWARD!  (out of track, reversed, sleeping)
             if self.all_wheels_on_track == False or self.is_reversed == True or (self.speed < (0.1 * self.MAX_SPEED)):
                 self.log_feature("all_wheels_on_track or is_reversed issue")
@@ -302,8 +550,7 @@ class RewardEvaluator:
                 result_reward = result_reward + float(self.REWARD_MAX * 0.6)
 
             # REWAR - Progress bonus
-            TOTAL_NUM_STEPS = 150
-            if (self.steps % 100 == 0) and self.progress > (self.steps / TOTAL_NUM_STEPS):
+            if self.is_progressing_ok():
                 self.log_feature("progressingOk")
                 result_reward = result_reward + self.REWARD_MAX * 0.4
 
@@ -313,8 +560,9 @@ class RewardEvaluator:
                 result_reward = float(self.REWARD_MAX)
 
         except Exception as e:
-            print("Error : " + str(e))
-            print(traceback.format_exc())
+            if self.guard is not None:
+                return self.guard.fallback(self, e)
+            log_error(e)
 
         # Finally - check reward value does not exceed maximum value
         if result_reward > 900000:
@@ -323,9 +571,447 @@ class RewardEvaluator:
         self.log_feature(result_reward)
         # self.status_to_string()
 
+        if self.guard is not None:
+            self.guard.finish(self, result_reward)
         return float(result_reward)
 
 
+# Raised when a feature method exceeded its work (number of track segments walked) or time budget
+class BudgetExceeded(Exception):
+    def __init__(self, method, walked):
+        Exception.__init__(self, "{0} exceeded its budget after {1} track segments".format(method, walked))
+
+
+# Errors of the reward calculation are printed (with traceback) at most once per ERROR_LOG_INTERVAL seconds - one
+# failing input repeated every step would otherwise flood the (paid) log. The number of errors not printed is added to
+# the next printed message.
+ERROR_LOG_INTERVAL = 60.0
+_error_log_state = {"last_time": None, "suppressed": 0}
+
+
+def log_error(e):
+    import time
+    import traceback  # imported lazily, it is needed only when something went wrong
+    now = time.monotonic()
+    last_time = _error_log_state["last_time"]
+    if last_time is not None and now - last_time < ERROR_LOG_INTERVAL:
+        _error_log_state["suppressed"] = _error_log_state["suppressed"] + 1
+        return False
+    print("Error : " + str(e) + " (" + str(_error_log_state["suppressed"]) + " similar errors not logged)")
+    print(traceback.format_exc())
+    _error_log_state["last_time"] = now
+    _error_log_state["suppressed"] = 0
+    return True
+
+
+class LatencyGuard:
+
+    # Budgeted evaluation mode. Every evaluation gets time_budget seconds - the horizon walks check the deadline (and
+    # their work counter, see RewardEvaluator.MAX_HORIZON_STEPS) on every track segment. When the budget is exceeded
+    # or any exception is raised, evaluate() returns a deterministic fallback reward instead: the last good reward
+    # calculated at the same closest waypoint of the track, or PENALTY_MAX when there is none. reward_function() runs
+    # the whole step under the guard - an exception of the evaluator construction (e.g. a degenerate track) or of the
+    # optional reward_cache, rolling_features and step_recorder falls back as well. Errors are logged rate-limited
+    # (see log_error()) and counted.
+    #
+    # Usage - at the end of this file: latency_guard = LatencyGuard(0.005)
+
+    def __init__(self, time_budget=0.005):
+        import time
+        self.clock = time.perf_counter
+        self.time_budget = time_budget
+        self.last_rewards = {}
+        self.evaluations = 0
+        self.budget_exceeded = 0
+        self.errors = 0
+        self.fallbacks = 0
+        self.slow = 0
+        self.started = 0.0
+
+    def start(self, evaluator):
+        self.evaluations = self.evaluations + 1
+        self.started = self.clock()
+        evaluator.clock = self.clock
+        evaluator.deadline = self.started + self.time_budget
+
+    def finish(self, evaluator, reward):
+        if self.clock() > evaluator.deadline:  # finished, but late (time spent outside the horizon walks)
+            self.slow = self.slow + 1
+        self.last_rewards[(evaluator.track.digest, evaluator.closest_waypoints[0])] = reward
+
+    # evaluator is None when it could not even be created, there is no waypoint to look the last good reward up then
+    def fallback(self, evaluator, e):
+        if isinstance(e, BudgetExceeded):
+            self.budget_exceeded = self.budget_exceeded + 1
+        else:
+            self.errors = self.errors + 1
+        log_error(e)
+        self.fallbacks = self.fallbacks + 1
+        if evaluator is None or evaluator.track is None:
+            return float(RewardEvaluator.PENALTY_MAX)
+        reward = self.last_rewards.get((evaluator.track.digest, evaluator.closest_waypoints[0]), evaluator.PENALTY_MAX)
+        evaluator.log_feature("fallback")
+        return float(reward)
+
+    def stats(self):
+        return {"evaluations": self.evaluations, "budget_exceeded": self.budget_exceeded, "errors": self.errors,
+                "fallbacks": self.fallbacks, "slow": self.slow}
+
+
+class StepRecorder:
+
+    # In-process "flight recorder" keeping the last `size` steps in preallocated typed arrays (a ring buffer). Nothing
+    # is logged while the car drives well - the buffer is written into a compact binary file only when something goes
+    # wrong: the car left the track, it is reversed, the reward is out of the expected range or the episode ended with
+    # low progress. Recording a step just overwrites one slot of each array, no objects are allocated.
+    #
+    # Usage - at the end of this file: step_recorder = StepRecorder(1000, "/tmp/deepracer")
+
+    COLUMNS = ("x", "y", "heading", "speed", "steering_angle", "reward", "progress")
+    MAGIC = b"DRSR"
+    HEADER_FORMAT = "<4sHHII"  # magic, version, trigger, number of steps, steps counter of the last step
+
+    # Dump triggers (stored in the header of the dump file)
+    TRIGGER_OFF_TRACK = 1
+    TRIGGER_REVERSED = 2
+    TRIGGER_REWARD_ANOMALY = 3
+    TRIGGER_LOW_PROGRESS = 4
+
+    def __init__(self, size=1000, directory=".", low_progress=50.0, reward_min=RewardEvaluator.PENALTY_MAX,
+                 reward_max=900000):
+        from array import array
+        self.size = size
+        self.directory = directory
+        self.low_progress = low_progress
+        self.reward_min = reward_min
+        self.reward_max = reward_max
+        self.x, self.y, self.heading, self.speed, self.steering_angle, self.reward, self.progress = \
+            [array('d', [0.0]) * size for _ in self.COLUMNS]
+        self.steps = array('I', [0]) * size
+        self.features = array('I', [0]) * size
+        self.index = 0
+        self.count = 0
+        self.last_steps = 0
+        self.last_progress = 0.0
+        self.episode_dumped = False
+        self.dumped_files = []
+
+    def record(self, params, reward, features=0):
+        steps = int(params['steps'])
+        # A new episode has started (steps is not increasing, also after a one-step episode) - check how the previous
+        # one ended
+        if self.count and steps <= self.last_steps:
+            if not self.episode_dumped and self.last_progress < self.low_progress:
+                self.dump(self.TRIGGER_LOW_PROGRESS)
+            self.episode_dumped = False
+            self.count = 0
+        index = self.index
+        self.x[index] = params['x']
+        self.y[index] = params['y']
+        self.heading[index] = params['heading']
+        self.speed[index] = params['speed']
+        self.steering_angle[index] = params['steering_angle']
+        self.reward[index] = reward
+        self.progress[index] = params['progress']
+        self.steps[index] = steps
+        self.features[index] = features
+        index = index + 1
+        self.index = 0 if index == self.size else index
+        if self.count < self.size:
+            self.count = self.count + 1
+        self.last_steps = steps
+        self.last_progress = params['progress']
+        if self.episode_dumped:
+            return
+        if not params['all_wheels_on_track']:
+            self.dump(self.TRIGGER_OFF_TRACK)
+        elif params['is_reversed']:
+            self.dump(self.TRIGGER_REVERSED)
+        elif not (self.reward_min <= reward <= self.reward_max):  # NaN fails the comparison as well
+            self.dump(self.TRIGGER_REWARD_ANOMALY)
+
+    # Writes the recorded steps (oldest first) into a new file and returns its path. The file consists of a header
+    # (HEADER_FORMAT) followed by the COLUMNS (doubles), steps and features (unsigned 32-bit) arrays.
+    def dump(self, trigger):
+        import os
+        import struct
+        start = (self.index - self.count) % self.size
+        path = os.path.join(self.directory, "steps-{0}-{1}.bin".format(os.getpid(), len(self.dumped_files)))
+        with open(path, "wb") as f:
+            f.write(struct.pack(self.HEADER_FORMAT, self.MAGIC, 1, trigger, self.count, self.last_steps))
+            for column in [getattr(self, name) for name in self.COLUMNS] + [self.steps, self.features]:
+                if start + self.count <= self.size:
+                    column[start:start + self.count].tofile(f)
+                else:
+                    column[start:].tofile(f)
+                    column[:start + self.count - self.size].tofile(f)
+        self.episode_dumped = True
+        self.dumped_files.append(path)
+        return path
+
+    # Reads a file written by dump() - returns (trigger, dictionary column name -> list of values, oldest step first)
+    @classmethod
+    def load(cls, path):
+        import struct
+        from array import array
+        with open(path, "rb") as f:
+            magic, version, trigger, count, last_steps = struct.unpack(
+                cls.HEADER_FORMAT, f.read(struct.calcsize(cls.HEADER_FORMAT)))
+            if magic != cls.MAGIC:
+                raise ValueError("Not a step recorder file: " + path)
+            columns = {}
+            for name, typecode in [(name, 'd') for name in cls.COLUMNS] + [("steps", 'I'), ("features", 'I')]:
+                values = array(typecode)
+                values.fromfile(f, count)
+                columns[name] = values.tolist()
+        return trigger, columns
+
+
+class RewardCache:
+
+    # Optional memo cache in front of RewardEvaluator.evaluate(). Training steps cluster heavily - the car passes the
+    # same waypoints again and again with one of the few discrete speeds and steering angles of the action space - so
+    # the reward is cached under a quantized state:
+    #   (track, closest waypoints, lateral offset bucket, heading error bucket, horizon intervals, speed, steering
+    #    angle, all_wheels_on_track, is_reversed, is_left_of_center, progress bonus, threshold flags)
+    # Tolerance: a state hitting an entry differs from the state the entry was evaluated for by less than one bucket
+    # width in the lateral offset (lateral_bucket [m]) and the heading error (heading_bucket [degrees]), by less than
+    # 10^-action_digits in speed and steering angle and by nothing else - and the reward of the hit is exactly the reward
+    # evaluate() calculates for it. The key contains the results of all comparisons evaluate() makes (threshold flags
+    # of the heading error, distance from the center line, speed for every possible optimum speed ratio and steering
+    # angle), and instead of the distance to the next waypoint the intervals of it in which both horizon walks pass
+    # the same segments (see TrackGeometry.get_horizon_breakpoints()). Only a distance equal to a breakpoint up to
+    # floating point rounding may be put on the other side of it. Use verify_every=N to re-evaluate every N-th hit and
+    # track the largest reward error actually seen. Fallback rewards of LatencyGuard are never cached. The least
+    # recently used entry is evicted when the cache holds max_size entries.
+
+    # All values get_optimum_speed_ratio() may return
+    OPTIMUM_SPEED_RATIOS = (0.33, 0.34, 0.66, 0.67, 1.0)
+
+    def __init__(self, max_size=100000, lateral_bucket=0.05, heading_bucket=5.0, action_digits=2, verify_every=0):
+        from bisect import bisect_right
+        from collections import OrderedDict
+        self.bisect = bisect_right
+        self.entries = OrderedDict()
+        self.max_size = max_size
+        self.lateral_bucket = lateral_bucket
+        self.heading_bucket = heading_bucket
+        self.action_digits = action_digits
+        self.verify_every = verify_every
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.verified = 0
+        self.max_reward_error = 0.0
+
+    def get_key(self, evaluator):
+        track = evaluator.track
+        offset = evaluator.distance_from_center if evaluator.is_left_of_center else -evaluator.distance_from_center
+        next_index = track.index_map[evaluator.closest_waypoints[1] % track.num_waypoints]
+        distance = evaluator.get_way_points_distance((evaluator.x, evaluator.y), track.points[next_index])
+        horizon_intervals = (
+            self.bisect(track.get_horizon_breakpoints(evaluator.SAFE_HORIZON_DISTANCE,
+                                                      evaluator.MAX_HORIZON_STEPS)[next_index], distance),
+            self.bisect(track.get_horizon_breakpoints(evaluator.SAFE_HORIZON_DISTANCE * 4.5,
+                                                      evaluator.MAX_HORIZON_STEPS)[next_index], distance))
+        heading_error = evaluator.get_car_heading_error()
+        corridor = evaluator.CENTERLINE_FOLLOW_RATIO_TRESHOLD * evaluator.track_width
+        speed = evaluator.speed
+        max_speed = evaluator.MAX_SPEED
+        thresholds = (abs(heading_error) <= evaluator.SMOOTH_STEERING_ANGLE_TRESHOLD,
+                      abs(heading_error) >= evaluator.MAX_STEERING_ANGLE * 0.75,
+                      abs(heading_error) >= evaluator.MAX_STEERING_ANGLE,
+                      evaluator.distance_from_center <= corridor * 2,
+                      evaluator.distance_from_center <= corridor / 2,
+                      abs(evaluator.steering_angle) <= evaluator.SMOOTH_STEERING_ANGLE_TRESHOLD,
+                      speed < 0.1 * max_speed,
+                      abs(speed - max_speed) < 0.1 * max_speed,
+                      evaluator.MIN_SPEED <= speed <= max_speed) + \
+            tuple(abs(speed - ratio * max_speed) < max_speed * 0.15 for ratio in self.OPTIMUM_SPEED_RATIOS)
+        return (track.digest, evaluator.closest_waypoints[0], evaluator.closest_waypoints[1],
+                math.floor(offset / self.lateral_bucket), math.floor(heading_error / self.heading_bucket),
+                horizon_intervals, round(speed, self.action_digits), round(evaluator.steering_angle, self.action_digits),
+                evaluator.all_wheels_on_track, evaluator.is_reversed, evaluator.is_left_of_center,
+                evaluator.is_progressing_ok(), thresholds)
+
+    # Returns the reward of the state of the evaluator - cached one when possible. The features bitmask of the
+    # evaluator is set as if evaluate() was called.
+    def evaluate(self, evaluator):
+        key = self.get_key(evaluator)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits = self.hits + 1
+            self.entries.move_to_end(key)
+            if self.verify_every and self.hits % self.verify_every == 0:
+                self.verified = self.verified + 1
+                error = abs(float(evaluator.evaluate()) - entry[0])
+                if error > self.max_reward_error:
+                    self.max_reward_error = error
+            evaluator.features = entry[1]
+            return entry[0]
+        self.misses = self.misses + 1
+        reward = float(evaluator.evaluate())
+        if evaluator.features & RewardEvaluator.FEATURE_BITS["fallback"]:
+            return reward
+        self.entries[key] = (reward, evaluator.features)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions = self.evictions + 1
+        return reward
+
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def stats(self):
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "hit_ratio": self.hit_ratio(), "verified": self.verified, "max_reward_error": self.max_reward_error}
+
+
+class RollingFeatures:
+
+    # Temporal features of the running episode - the reward function itself has no history. Exponential moving
+    # averages and statistics of the last `window` steps are updated in O(1) per step: cumulative sums of the step
+    # values are kept in preallocated ring buffers of window + 1 entries, a window sum is the difference of two of them.
+    # The state is reset when a new episode starts (steps is not increasing). Features (attributes, see FEATURES):
+    #   progress_rate, progress_rate_ema - progress (percent) per step, window mean and EMA
+    #   steering_variance                - variance of the steering angle in the window
+    #   speed_trend, speed_ema           - slope (per step) of the speed in the window and its EMA
+    #   heading_error_trend, heading_error_ema - the same for the absolute heading error
+    # bulk() calculates the same features for whole replayed trace columns with prefix sums, giving identical values.
+    #
+    # Usage - at the end of this file: rolling_features = RollingFeatures(), then use self.rolling in evaluate().
+    # Do not combine with reward_cache when the reward depends on these features, the cache key does not include them.
+
+    FEATURES = ("progress_rate", "progress_rate_ema", "steering_variance", "speed_trend", "speed_ema",
+                "heading_error_trend", "heading_error_ema")
+    NUM_SUMS = 7  # progress delta, steering, steering^2, speed, t * speed, heading error, t * heading error
+
+    def __init__(self, window=15, alpha=0.1):
+        from array import array
+        self.window = window
+        self.alpha = alpha
+        self.slots = window + 1
+        self.history = array('d', [0.0]) * (self.slots * self.NUM_SUMS)  # cumulative sums, one row per step
+        self.totals = array('d', [0.0]) * self.NUM_SUMS
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.last_steps = None
+        self.last_progress = 0.0
+        for index in range(self.NUM_SUMS):
+            self.totals[index] = 0.0
+            self.history[index] = 0.0
+        for name in self.FEATURES:
+            setattr(self, name, 0.0)
+
+    # Statistics of the last n of count values of the episode given the window sums (differences of cumulative sums).
+    # Values are indexed t = 0..count-1 within the episode, the trend is the least squares slope over t.
+    @staticmethod
+    def window_statistics(count, n, progress_sum, steering_sum, steering_square_sum, speed_sum, t_speed_sum,
+                          heading_sum, t_heading_sum):
+        steering_mean = steering_sum / n
+        steering_variance = max(0.0, steering_square_sum / n - steering_mean * steering_mean)
+        if n > 1:
+            t_sum = n * (2 * count - n - 1) / 2.0
+            denominator = n * n * (n * n - 1) / 12.0
+            speed_trend = (n * t_speed_sum - t_sum * speed_sum) / denominator
+            heading_error_trend = (n * t_heading_sum - t_sum * heading_sum) / denominator
+        else:
+            speed_trend = 0.0
+            heading_error_trend = 0.0
+        return progress_sum / n, steering_variance, speed_trend, heading_error_trend
+
+    def update(self, steps, progress, steering_angle, speed, heading_error):
+        # Invalid input raises here, before any state is changed
+        progress = float(progress)
+        steering_angle = float(steering_angle)
+        speed = float(speed)
+        heading_error = abs(float(heading_error))
+        if self.last_steps is not None and steps <= self.last_steps:
+            self.reset()
+        t = self.count
+        progress_delta = progress - self.last_progress
+        totals = self.totals
+        totals[0] = totals[0] + progress_delta
+        totals[1] = totals[1] + steering_angle
+        totals[2] = totals[2] + steering_angle * steering_angle
+        totals[3] = totals[3] + speed
+        totals[4] = totals[4] + t * speed
+        totals[5] = totals[5] + heading_error
+        totals[6] = totals[6] + t * heading_error
+        count = t + 1
+        num_sums = self.NUM_SUMS
+        history = self.history
+        row = (count % self.slots) * num_sums
+        history[row:row + num_sums] = totals
+        n = count if count < self.window else self.window
+        start = ((count - n) % self.slots) * num_sums
+        self.progress_rate, self.steering_variance, self.speed_trend, self.heading_error_trend = \
+            self.window_statistics(count, n, *[totals[index] - history[start + index] for index in range(num_sums)])
+        if t == 0:
+            self.progress_rate_ema = progress_delta
+            self.speed_ema = speed
+            self.heading_error_ema = heading_error
+        else:
+            alpha = self.alpha
+            self.progress_rate_ema = self.progress_rate_ema + alpha * (progress_delta - self.progress_rate_ema)
+            self.speed_ema = self.speed_ema + alpha * (speed - self.speed_ema)
+            self.heading_error_ema = self.heading_error_ema + alpha * (heading_error - self.heading_error_ema)
+        self.count = count
+        self.last_steps = steps
+        self.last_progress = progress
+        return self
+
+    def values(self):
+        return dict((name, getattr(self, name)) for name in self.FEATURES)
+
+    # Calculates the features of every step of replayed columns (e.g. of TraceArchive plus the heading error) at once.
+    # Episodes are split where steps is not increasing, as in update(). Returns dictionary feature -> list of values.
+    def bulk(self, steps, progress, steering_angle, speed, heading_error):
+        from itertools import accumulate
+        result = dict((name, []) for name in self.FEATURES)
+        boundaries = [0] + [index for index in range(1, len(steps)) if steps[index] <= steps[index - 1]] + [len(steps)]
+        alpha = self.alpha
+        window = self.window
+        for first, last in zip(boundaries, boundaries[1:]):
+            if first == last:
+                continue
+            progress_deltas = [value - previous for previous, value in zip([0.0] + list(progress[first:last - 1]),
+                                                                          progress[first:last])]
+            steerings = steering_angle[first:last]
+            speeds = speed[first:last]
+            heading_errors = [abs(value) for value in heading_error[first:last]]
+            columns = (progress_deltas, steerings, [value * value for value in steerings], speeds,
+                       [t * value for t, value in enumerate(speeds)], heading_errors,
+                       [t * value for t, value in enumerate(heading_errors)])
+            prefix_sums = [list(accumulate(column, initial=0.0)) for column in columns]
+            for count in range(1, last - first + 1):
+                n = count if count < window else window
+                statistics = self.window_statistics(count, n, *[prefix[count] - prefix[count - n]
+                                                                for prefix in prefix_sums])
+                for name, value in zip(("progress_rate", "steering_variance", "speed_trend", "heading_error_trend"),
+                                       statistics):
+                    result[name].append(value)
+            for name, column in (("progress_rate_ema", progress_deltas), ("speed_ema", speeds),
+                                 ("heading_error_ema", heading_errors)):
+                result[name].extend(accumulate(column, lambda average, value: average + alpha * (value - average)))
+        return result
+
+
+# Optional StepRecorder instance - when set, every step is recorded and the last steps are dumped on failures
+step_recorder = None
+
+# Optional RewardCache instance - when set, rewards of (quantized) states seen before are not evaluated again
+reward_cache = None
+
+# Optional LatencyGuard instance - when set, every evaluation runs with a time budget and a fallback reward
+latency_guard = None
+
+# Optional RollingFeatures instance - when set, it is updated every step and available as self.rolling in evaluate()
+rolling_features = None
+
 """
 This is the core function called by the environment to calculate reward value for every point of time of the training. 
 params: input values for the reward calculation (see above)
@@ -336,5 +1022,21 @@ RewardEvaluator which has implemented a set of features one can easily combine a
 
 
 def reward_function(params):
-    re = RewardEvaluator(params)
-    return float(re.evaluate())
+    re = None
+    try:
+        re = RewardEvaluator(params)
+        re.guard = latency_guard
+        if rolling_features is not None:
+            re.rolling = rolling_features.update(params['steps'], params['progress'], params['steering_angle'],
+                                                 params['speed'], re.get_car_heading_error())
+        if reward_cache is not None:
+            reward = reward_cache.evaluate(re)
+        else:
+            reward = float(re.evaluate())
+        if step_recorder is not None:
+            step_recorder.record(params, reward, re.features)
+        return reward
+    except Exception as e:
+        if latency_guard is None:
+            raise
+        return latency_guard.fallback(re, e)
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import io
+
+from reward_function import RewardEvaluator
+
+"""
+Single pass evaluation of many reward designs. When A/B testing reward strategies on replayed data, the expensive part
+of RewardEvaluator.evaluate() is the feature computation (heading error, turn angle, horizon walks, corridor check)
+which is the same for every design - only weights, thresholds and branches of the reward formula differ. The
+MultiVariantEvaluator computes the features once per step and applies any number of RewardVariant formulas to them,
+so comparing 20 candidate rewards costs little more than evaluating one.
+
+This module is a development tool only, it is not supposed to be pasted into the AWS console.
+"""
+
+
+class StepFeatures:
+
+    # Features of one step shared by all variants, calculated in the order evaluate() needs them. When the calculation
+    # of a feature fails (e.g. BudgetExceeded on a tiny track), it and all the features after it are None and error is
+    # set - evaluate() would stop at the same point with the reward terms earned so far. optimum_speed_ratio is
+    # calculated only in a turn (evaluate() does not need it anywhere else), it is None otherwise. constants are the
+    # values of the EVALUATOR_CONSTANTS of the evaluator (including the tuning of a known track).
+    __slots__ = ("all_wheels_on_track", "is_reversed", "speed", "steering_angle", "heading_error", "in_corridor",
+                 "in_turn", "optimum_speed_ratio", "steps", "progress", "reached_target", "error", "constants")
+
+    EVALUATOR_CONSTANTS = ("REWARD_MAX", "PENALTY_MAX", "MAX_SPEED", "MIN_SPEED", "SMOOTH_STEERING_ANGLE_TRESHOLD",
+                           "TOTAL_NUM_STEPS")
+
+    def __init__(self, evaluator):
+        self.all_wheels_on_track = evaluator.all_wheels_on_track
+        self.is_reversed = evaluator.is_reversed
+        self.speed = evaluator.speed
+        self.steering_angle = evaluator.steering_angle
+        self.steps = evaluator.steps
+        self.progress = evaluator.progress
+        self.constants = tuple(getattr(evaluator, name) for name in self.EVALUATOR_CONSTANTS)
+        self.heading_error = None
+        self.in_corridor = None
+        self.in_turn = None
+        self.optimum_speed_ratio = None
+        self.reached_target = None
+        self.error = None
+        try:
+            self.heading_error = evaluator.get_car_heading_error()
+            self.in_corridor = evaluator.is_in_optimized_corridor()
+            self.in_turn = evaluator.is_in_turn()
+            if self.in_turn:
+                self.optimum_speed_ratio = evaluator.get_optimum_speed_ratio()
+            self.reached_target = evaluator.reached_target()
+        except Exception as e:
+            self.error = e
+
+
+# Raised by RewardVariant.reward() when a feature it needs could not be calculated (see StepFeatures)
+class MissingFeature(Exception):
+    pass
+
+
+def required(value):
+    if value is None:
+        raise MissingFeature()
+    return value
+
+
+class RewardVariant:
+
+    # One reward design - the formula of RewardEvaluator.evaluate() with its weights and thresholds as parameters.
+    # A variant created without overrides gives exactly the same reward as evaluate() of the evaluator class the
+    # features come from, the error path included. Parameters in EVALUATOR_DEFAULTS default to the constants of that
+    # evaluator (its class and the tuning of a known track), the other ones to DEFAULTS. Weights are fractions of
+    # reward_max as in evaluate(), a zero weight switches the branch off. Thresholds used inside the shared features
+    # (corridor width, turn angle, safe horizon) are those of the evaluator class and can not be changed per variant.
+    DEFAULTS = {
+        "reward_cap": 900000,
+        "stop_speed_ratio": 0.1,
+        "straight_speed_tolerance": 0.1,
+        "optimum_speed_tolerance": 0.15,
+        "heading_weight": 0.3,
+        "steering_weight": 0.15,
+        "corridor_weight": 0.45,
+        "straight_max_speed_weight": 1.0,
+        "curve_optimum_speed_weight": 0.6,
+        "progress_weight": 0.4,
+        "reached_target_bonus": True,
+    }
+
+    # Parameter -> RewardEvaluator constant (one of StepFeatures.EVALUATOR_CONSTANTS) it defaults to
+    EVALUATOR_DEFAULTS = {
+        "reward_max": "REWARD_MAX",
+        "penalty": "PENALTY_MAX",
+        "max_speed": "MAX_SPEED",
+        "min_speed": "MIN_SPEED",
+        "smooth_heading_threshold": "SMOOTH_STEERING_ANGLE_TRESHOLD",
+        "smooth_steering_threshold": "SMOOTH_STEERING_ANGLE_TRESHOLD",
+        "total_num_steps": "TOTAL_NUM_STEPS",
+    }
+
+    def __init__(self, name, **overrides):
+        unknown = set(overrides) - set(self.DEFAULTS) - set(self.EVALUATOR_DEFAULTS)
+        if unknown:
+            raise ValueError("Unknown reward variant parameters: " + ", ".join(sorted(unknown)))
+        self.name = name
+        self.overrides = overrides
+        self.resolved = {}  # evaluator constants -> VariantParameters
+
+    # Parameters of the variant for the given evaluator constants, resolved once per evaluator class and track
+    def get_parameters(self, constants):
+        parameters = self.resolved.get(constants)
+        if parameters is None:
+            values = dict(self.DEFAULTS)
+            evaluator_constants = dict(zip(StepFeatures.EVALUATOR_CONSTANTS, constants))
+            for key, constant in self.EVALUATOR_DEFAULTS.items():
+                values[key] = evaluator_constants[constant]
+            values.update(self.overrides)
+            parameters = VariantParameters(values)
+            self.resolved[constants] = parameters
+        return parameters
+
+    def reward(self, features):
+        p = self.get_parameters(features.constants)
+        result_reward = float(0.001)
+        # The same sequence of terms as in evaluate(). Any failure (a missing feature or an invalid input value) ends
+        # the sequence and the terms earned so far are kept, exactly as evaluate() catches the exception.
+        try:
+            if features.all_wheels_on_track == False or features.is_reversed == True or features.speed < p.stop_speed:
+                return float(p.penalty)
+            heading_ok = abs(required(features.heading_error)) <= p.smooth_heading_threshold
+            if heading_ok:
+                result_reward = result_reward + p.heading_reward
+            if abs(features.steering_angle) <= p.smooth_steering_threshold:
+                result_reward = result_reward + p.steering_reward
+            if required(features.in_corridor):
+                result_reward = result_reward + p.corridor_reward
+            in_turn = required(features.in_turn)
+            if not in_turn and abs(features.speed - p.max_speed) < (p.straight_speed_tolerance * p.max_speed) \
+                    and heading_ok:
+                result_reward = result_reward + p.straight_max_speed_reward
+            if in_turn and abs(features.speed - required(features.optimum_speed_ratio) * p.max_speed) < \
+                    (p.max_speed * p.optimum_speed_tolerance) and p.min_speed <= features.speed <= p.max_speed:
+                result_reward = result_reward + p.curve_optimum_speed_reward
+            if (features.steps % 100 == 0) and features.progress > (features.steps / p.total_num_steps):
+                result_reward = result_reward + p.progress_reward
+            if p.reached_target_bonus and required(features.reached_target):
+                result_reward = float(p.reward_max)
+        except Exception:
+            pass
+        if result_reward > p.reward_cap:
+            result_reward = p.reward_cap
+        return float(result_reward)
+
+
+class VariantParameters:
+
+    # Resolved parameters of a RewardVariant with the terms precalculated - reward() is called once per variant and
+    # step
+    def __init__(self, values):
+        for key, value in values.items():
+            setattr(self, key, value)
+        self.heading_reward = self.reward_max * self.heading_weight
+        self.steering_reward = self.reward_max * self.steering_weight
+        self.corridor_reward = float(self.reward_max * self.corridor_weight)
+        self.straight_max_speed_reward = float(self.reward_max * self.straight_max_speed_weight)
+        self.curve_optimum_speed_reward = float(self.reward_max * self.curve_optimum_speed_weight)
+        self.progress_reward = self.reward_max * self.progress_weight
+        self.stop_speed = self.stop_speed_ratio * self.max_speed
+
+
+class MultiVariantEvaluator:
+
+    # Evaluates all variants (RewardVariant instances or any callable taking StepFeatures and returning the reward)
+    # for every step, the features being calculated only once per step by the evaluator_class.
+    def __init__(self, variants, evaluator_class=RewardEvaluator):
+        self.variants = list(variants)
+        self.names = [getattr(variant, "name", getattr(variant, "__name__", str(index)))
+                      for index, variant in enumerate(self.variants)]
+        self.reward_functions = [variant.reward if isinstance(variant, RewardVariant) else variant
+                                 for variant in self.variants]
+        self.evaluator_class = evaluator_class
+
+    def get_features(self, params):
+        with contextlib.redirect_stdout(io.StringIO()):  # evaluator methods may log, the replay does not need it
+            return StepFeatures(self.evaluator_class(params))
+
+    # Returns the list of rewards (in the order of variants) for one step
+    def evaluate(self, params):
+        features = self.get_features(params)
+        return [reward(features) for reward in self.reward_functions]
+
+    # Replays all steps, returns dictionary variant name -> list of rewards (one reward column per variant)
+    def evaluate_all(self, params_list):
+        columns = [[] for _ in self.reward_functions]
+        for params in params_list:
+            features = self.get_features(params)
+            for column, reward in zip(columns, self.reward_functions):
+                column.append(reward(features))
+        return dict(zip(self.names, columns))
@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import io
+import json
+import math
+import os
+import socket
+import sqlite3
+import sys
+import time
+
+from reward_function import RewardEvaluator
+from trace_archive import TraceArchive
+
+"""
+Sharded replay of archived traces (see trace_archive.py) over many RewardEvaluator configurations. The coordinator
+splits the work into shards - a range of episodes replayed with one configuration - and publishes them into a work
+queue kept in an SQLite file. Any number of worker processes claim shards with a time-limited lease, renew it between
+replayed episodes (the lease must be longer than the longest episode takes to replay) and stream partial aggregates
+back after every few episodes. A shard whose worker crashed is claimed again once its lease expired, a shard failing
+repeatedly is given up after `max_attempts`. The coordinator finally merges the partial aggregates per configuration.
+
+The queue relies on SQLite file locking, which is reliable on a local filesystem only - keep the queue file on a local
+disk of one host and run the workers there. Network filesystems (NFS in particular) do not implement the locks
+SQLite needs, workers on several hosts sharing the file over NFS can claim the same shard or corrupt the queue.
+
+Usage:
+    python sweep_coordinator.py publish queue.db training.dta track.json configurations.json
+    python sweep_coordinator.py work queue.db
+    python sweep_coordinator.py merge queue.db
+
+track.json holds {"waypoints": [...], "track_width": ...} of the track the archive was recorded on,
+configurations.json a list of {"name": ..., "constants": {"REWARD_MAX": ..., ...}} (RewardEvaluator constants).
+
+This module is a development tool only, it is not supposed to be pasted into the AWS console.
+"""
+
+# Shard states
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS shards (
+    id INTEGER PRIMARY KEY,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL,
+    owner TEXT,
+    lease_expiry REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS partials (
+    shard_id INTEGER NOT NULL,
+    sequence INTEGER NOT NULL,
+    aggregate TEXT NOT NULL,
+    PRIMARY KEY (shard_id, sequence)
+);
+CREATE INDEX IF NOT EXISTS shards_state ON shards (state, lease_expiry);
+"""
+
+
+class Shard:
+
+    def __init__(self, shard_id, payload, attempts):
+        self.id = shard_id
+        self.payload = payload
+        self.attempts = attempts
+
+    def __repr__(self):
+        return "Shard({0}, {1}, attempts={2})".format(self.id, self.payload.get("configuration"), self.attempts)
+
+
+class SweepQueue:
+
+    # Work queue in an SQLite file. Every state change runs in its own immediate (write-locking) transaction, so any
+    # number of processes can share the file (on a local filesystem, see the module description). A lease is owned by
+    # the worker until lease_expiry (wall-clock time) - a worker which lost its lease can neither report partial
+    # aggregates nor complete the shard, its work is done again by the next owner.
+    def __init__(self, path, lease_seconds=60.0, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.connection = sqlite3.connect(path, timeout=60.0, isolation_level=None)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        cursor = self.connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            yield cursor
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+        cursor.execute("COMMIT")
+
+    # Adds shards (payload dictionaries) to the queue, returns their ids
+    def publish(self, payloads):
+        ids = []
+        with self.transaction() as cursor:
+            for payload in payloads:
+                cursor.execute("INSERT INTO shards (payload, state) VALUES (?, ?)", (json.dumps(payload), PENDING))
+                ids.append(cursor.lastrowid)
+        return ids
+
+    # Leases the next pending shard (or a shard whose lease expired) to the owner. Returns Shard or None when there
+    # is nothing to claim at the moment. Partial aggregates of a previous attempt are dropped, the shard is replayed
+    # from its start.
+    def claim(self, owner):
+        now = time.time()
+        with self.transaction() as cursor:
+            cursor.execute("UPDATE shards SET state = ?, owner = NULL, error = 'lease expired' "
+                           "WHERE state = ? AND lease_expiry < ? AND attempts >= ?",
+                           (FAILED, LEASED, now, self.max_attempts))
+            row = cursor.execute("SELECT id, payload, attempts FROM shards WHERE state = ? "
+                                 "OR (state = ? AND lease_expiry < ?) ORDER BY id LIMIT 1",
+                                 (PENDING, LEASED, now)).fetchone()
+            if row is None:
+                return None
+            shard_id, payload, attempts = row
+            cursor.execute("UPDATE shards SET state = ?, owner = ?, lease_expiry = ?, attempts = ? WHERE id = ?",
+                           (LEASED, owner, now + self.lease_seconds, attempts + 1, shard_id))
+            cursor.execute("DELETE FROM partials WHERE shard_id = ?", (shard_id,))
+        return Shard(shard_id, json.loads(payload), attempts + 1)
+
+    def _is_owner(self, cursor, shard_id, owner):
+        row = cursor.execute("SELECT owner, state, lease_expiry FROM shards WHERE id = ?", (shard_id,)).fetchone()
+        return row is not None and row[0] == owner and row[1] == LEASED and row[2] >= time.time()
+
+    # Extends the lease, returns False when the owner has lost it
+    def renew(self, shard_id, owner):
+        with self.transaction() as cursor:
+            if not self._is_owner(cursor, shard_id, owner):
+                return False
+            cursor.execute("UPDATE shards SET lease_expiry = ? WHERE id = ?", (time.time() + self.lease_seconds,
+                                                                              shard_id))
+        return True
+
+    # Stores a partial aggregate (a JSON-serializable dictionary) and renews the lease. Returns False (and stores
+    # nothing) when the owner has lost the lease.
+    def report_partial(self, shard_id, owner, sequence, aggregate):
+        with self.transaction() as cursor:
+            if not self._is_owner(cursor, shard_id, owner):
+                return False
+            cursor.execute("INSERT OR REPLACE INTO partials (shard_id, sequence, aggregate) VALUES (?, ?, ?)",
+                           (shard_id, sequence, json.dumps(aggregate)))
+            cursor.execute("UPDATE shards SET lease_expiry = ? WHERE id = ?", (time.time() + self.lease_seconds,
+                                                                              shard_id))
+        return True
+
+    def complete(self, shard_id, owner):
+        with self.transaction() as cursor:
+            if not self._is_owner(cursor, shard_id, owner):
+                return False
+            cursor.execute("UPDATE shards SET state = ?, owner = NULL, lease_expiry = NULL, error = NULL "
+                           "WHERE id = ?", (DONE, shard_id))
+        return True
+
+    # Releases a shard which could not be processed - it is claimed again unless it has run out of attempts
+    def fail(self, shard_id, owner, error):
+        with self.transaction() as cursor:
+            if not self._is_owner(cursor, shard_id, owner):
+                return False
+            attempts = cursor.execute("SELECT attempts FROM shards WHERE id = ?", (shard_id,)).fetchone()[0]
+            cursor.execute("UPDATE shards SET state = ?, owner = NULL, lease_expiry = NULL, error = ? WHERE id = ?",
+                           (FAILED if attempts >= self.max_attempts else PENDING, str(error), shard_id))
+        return True
+
+    # Dictionary state -> number of shards
+    def counts(self):
+        counts = dict((state, 0) for state in (PENDING, LEASED, DONE, FAILED))
+        for state, count in self.connection.execute("SELECT state, COUNT(*) FROM shards GROUP BY state"):
+            counts[state] = count
+        return counts
+
+    def unfinished(self):
+        counts = self.counts()
+        return counts[PENDING] + counts[LEASED]
+
+    def errors(self):
+        return dict(self.connection.execute("SELECT id, error FROM shards WHERE state = ?", (FAILED,)).fetchall())
+
+    # Yields (shard payload, partial aggregate) of all done shards (or of all shards with include_running=True,
+    # e.g. to watch a running sweep)
+    def partials(self, include_running=False):
+        query = ("SELECT shards.payload, partials.aggregate FROM partials JOIN shards ON shards.id = partials.shard_id"
+                 + ("" if include_running else " WHERE shards.state = '" + DONE + "'")
+                 + " ORDER BY partials.shard_id, partials.sequence")
+        for payload, aggregate in self.connection.execute(query):
+            yield json.loads(payload), json.loads(aggregate)
+
+
+class ReplayAggregate:
+
+    # Mergeable statistics of the rewards of replayed steps. Merging aggregates of any split of the steps gives the
+    # same result (up to the floating point rounding of the sums) as aggregating all steps at once.
+    def __init__(self, steps=0, episodes=0, reward_sum=0.0, reward_square_sum=0.0, reward_min=None, reward_max=None):
+        self.steps = steps
+        self.episodes = episodes
+        self.reward_sum = reward_sum
+        self.reward_square_sum = reward_square_sum
+        self.reward_min = reward_min
+        self.reward_max = reward_max
+
+    def add(self, reward):
+        self.steps = self.steps + 1
+        self.reward_sum = self.reward_sum + reward
+        self.reward_square_sum = self.reward_square_sum + reward * reward
+        if self.reward_min is None or reward < self.reward_min:
+            self.reward_min = reward
+        if self.reward_max is None or reward > self.reward_max:
+            self.reward_max = reward
+
+    def merge(self, other):
+        self.steps = self.steps + other.steps
+        self.episodes = self.episodes + other.episodes
+        self.reward_sum = self.reward_sum + other.reward_sum
+        self.reward_square_sum = self.reward_square_sum + other.reward_square_sum
+        for value in (other.reward_min, other.reward_max):
+            if value is not None:
+                if self.reward_min is None or value < self.reward_min:
+                    self.reward_min = value
+                if self.reward_max is None or value > self.reward_max:
+                    self.reward_max = value
+        return self
+
+    def mean(self):
+        return self.reward_sum / self.steps if self.steps else None
+
+    def std(self):
+        if not self.steps:
+            return None
+        mean = self.reward_sum / self.steps
+        return math.sqrt(max(0.0, self.reward_square_sum / self.steps - mean * mean))
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**values)
+
+
+# Creates a RewardEvaluator subclass with the given constants (e.g. {"REWARD_MAX": 1000}) overridden
+def make_evaluator_class(name, constants):
+    for key in constants:
+        if not key.isupper() or not hasattr(RewardEvaluator, key):
+            raise ValueError("Unknown RewardEvaluator constant: " + key)
+    return type(str(name), (RewardEvaluator,), dict(constants))
+
+
+# Builds the reward function params of one replayed step from the trace columns (see TraceArchive) and the track.
+# The values not present in the trace (distance from center, side) are calculated from the position and the segment
+# between the closest waypoints.
+def trace_params(track, columns, index):
+    waypoints = track["waypoints"]
+    num_waypoints = len(waypoints)
+    closest_waypoint = int(columns["closest_waypoint_index"][index]) % num_waypoints
+    next_waypoint = (closest_waypoint + 1) % num_waypoints
+    x = columns["x"][index]
+    y = columns["y"][index]
+    prev_point = waypoints[closest_waypoint]
+    next_point = waypoints[next_waypoint]
+    segment_x = next_point[0] - prev_point[0]
+    segment_y = next_point[1] - prev_point[1]
+    segment_length = math.hypot(segment_x, segment_y)
+    cross = segment_x * (y - prev_point[1]) - segment_y * (x - prev_point[0])
+    all_wheels_on_track = bool(columns["all_wheels_on_track"][index])
+    return {
+        "all_wheels_on_track": all_wheels_on_track,
+        "x": x,
+        "y": y,
+        "distance_from_center": abs(cross) / segment_length if segment_length > 0 else 0.0,
+        "is_left_of_center": cross > 0,
+        "is_offtrack": not all_wheels_on_track,
+        "is_reversed": False,
+        "heading": columns["heading"][index],
+        "progress": columns["progress"][index],
+        "steps": int(columns["steps"][index]),
+        "speed": columns["speed"][index],
+        "steering_angle": columns["steering"][index],
+        "track_width": track["track_width"],
+        "track_length": columns["track_length"][index],
+        "waypoints": waypoints,
+        "closest_waypoints": [closest_waypoint, next_waypoint],
+    }
+
+
+# Splits the episodes of the archive into ranges of `episodes_per_shard` and creates one shard payload per range and
+# configuration ({"name": ..., "constants": {...}}).
+def make_shards(archive_path, track, configurations, episodes_per_shard=50):
+    episodes = TraceArchive(archive_path).episodes()
+    track = {"waypoints": [list(point) for point in track["waypoints"]], "track_width": track["track_width"]}
+    payloads = []
+    for configuration in configurations:
+        make_evaluator_class(configuration["name"], configuration.get("constants", {}))  # Fail early on a typo
+        for start in range(0, len(episodes), episodes_per_shard):
+            payloads.append({"archive": os.path.abspath(archive_path), "track": track,
+                             "episodes": episodes[start:start + episodes_per_shard],
+                             "configuration": configuration["name"],
+                             "constants": configuration.get("constants", {})})
+    return payloads
+
+
+# Replays the episodes of one shard, yields a ReplayAggregate every `partial_episodes` episodes (and for the rest).
+# The optional `renew` callable is called after every episode, the replay stops when it returns False (the lease has
+# been lost).
+def replay_shard(payload, partial_episodes=10, renew=None):
+    archive = TraceArchive(payload["archive"])
+    evaluator_class = make_evaluator_class(payload["configuration"], payload["constants"])
+    track = payload["track"]
+    aggregate = ReplayAggregate()
+    with contextlib.redirect_stdout(io.StringIO()):  # evaluator methods may log, the replay does not need it
+        for episode in payload["episodes"]:
+            columns = archive.read_episode(episode)
+            for index in range(len(columns["steps"])):
+                aggregate.add(float(evaluator_class(trace_params(track, columns, index)).evaluate()))
+            aggregate.episodes = aggregate.episodes + 1
+            if renew is not None and not renew():
+                return
+            if aggregate.episodes == partial_episodes:
+                yield aggregate
+                aggregate = ReplayAggregate()
+    if aggregate.episodes:
+        yield aggregate
+
+
+class LeaseRenewal:
+
+    # Callable renewing the lease of a shard, at most once per a quarter of the lease. Returns False once the lease
+    # has been lost.
+    def __init__(self, queue, shard_id, owner):
+        self.queue = queue
+        self.shard_id = shard_id
+        self.owner = owner
+        self.owned = True
+        self.renewed = time.time()
+
+    def __call__(self):
+        now = time.time()
+        if self.owned and now - self.renewed >= self.queue.lease_seconds / 4.0:
+            self.owned = self.queue.renew(self.shard_id, self.owner)
+            self.renewed = now
+        return self.owned
+
+
+def get_worker_name():
+    return "{0}:{1}".format(socket.gethostname(), os.getpid())
+
+
+# Worker loop - claims and replays shards until there is nothing left. With wait=True it keeps polling while other
+# workers hold leases (their shards come back when a worker crashed). The lease is renewed between episodes once a
+# quarter of it has passed. Returns the number of shards completed.
+def run_worker(queue_path, owner=None, lease_seconds=60.0, max_attempts=3, partial_episodes=10, wait=True,
+               poll_interval=0.5):
+    owner = owner or get_worker_name()
+    queue = SweepQueue(queue_path, lease_seconds, max_attempts)
+    completed = 0
+    try:
+        while True:
+            shard = queue.claim(owner)
+            if shard is None:
+                if not wait or queue.unfinished() == 0:
+                    return completed
+                time.sleep(poll_interval)
+                continue
+            renewal = LeaseRenewal(queue, shard.id, owner)
+            try:
+                for sequence, aggregate in enumerate(replay_shard(shard.payload, partial_episodes, renewal)):
+                    if not queue.report_partial(shard.id, owner, sequence, aggregate.to_dict()):
+                        break  # The lease has been lost, the shard is someone else's now
+                else:
+                    if renewal.owned and queue.complete(shard.id, owner):
+                        completed = completed + 1
+            except Exception as e:
+                queue.fail(shard.id, owner, repr(e))
+    finally:
+        queue.close()
+
+
+# Merges the partial aggregates of all done shards, returns dictionary configuration name -> ReplayAggregate
+def merge_results(queue_path, include_running=False):
+    queue = SweepQueue(queue_path)
+    results = {}
+    try:
+        for payload, aggregate in queue.partials(include_running):
+            results.setdefault(payload["configuration"], ReplayAggregate()).merge(
+                ReplayAggregate.from_dict(aggregate))
+    finally:
+        queue.close()
+    return results
+
+
+if __name__ == '__main__':
+    command, path = sys.argv[1], sys.argv[2]
+    if command == "publish":
+        with open(sys.argv[4]) as f:
+            track_json = json.load(f)
+        with open(sys.argv[5]) as f:
+            configurations_json = json.load(f)
+        sweep_queue = SweepQueue(path)
+        published = sweep_queue.publish(make_shards(sys.argv[3], track_json, configurations_json))
+        print("Published " + str(len(published)) + " shards")
+    elif command == "work":
+        print("Completed " + str(run_worker(path)) + " shards")
+    elif command == "merge":
+        for name, result in sorted(merge_results(path).items()):
+            print("{0}: {1} episodes, {2} steps, reward mean {3:.4f}, std {4:.4f}, min {5}, max {6}".format(
+                name, result.episodes, result.steps, result.mean(), result.std(), result.reward_min,
+                result.reward_max))
+        print(SweepQueue(path).counts())
+    else:
+        sys.exit("Unknown command: " + command)
@@ -226,12 +226,19 @@ params_reinvent2018 = {
 # copy which allows the manipulation and avoids any manipulation will harm another test.
 
 
+# Samples by name - both the historical names and the track names used by the track registry in reward_function.py
+params_by_name = {
+    "BOWTLE": params_bowtle,
+    "Bowtie": params_bowtle,
+    "params_reinvent2018": params_reinvent2018,
+    "reInvent2018": params_reinvent2018,
+}
+
+
 def get_copy_of_params(param_name=None):
     if param_name is None:
         return copy.deepcopy(params_default)
-    elif param_name == "BOWTLE":
-        return copy.deepcopy(params_bowtle)
-    elif param_name == "params_reinvent2018":
-        return copy.deepcopy(params_reinvent2018)
+    elif param_name in params_by_name:
+        return copy.deepcopy(params_by_name[param_name])
     else:
         return None
@@ -5,11 +5,20 @@ This is the test code used to test implemented methods and function in the ../re
 unit test is optional for you to use. You will not use it for purpose of training in AWS console.
 """
 
+import contextlib
+import copy
+import io
 import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
 import unittest
 
+import reward_function
 from parms.parms import get_copy_of_params as get_test_params
-from reward_function import RewardEvaluator
+from reward_function import BudgetExceeded, LatencyGuard, RewardCache, RewardEvaluator, RollingFeatures, StepRecorder
 
 
 class RewardEvaluatorTestCase(unittest.TestCase):
@@ -319,6 +328,580 @@ class RewardEvaluatorTestCase(unittest.TestCase):
         # self.print_get_turn_angle()
         # self.print_get_expected_turn_direction()
 
+    def test_track_geometry_is_cached(self):
+        params_test = get_test_params("params_reinvent2018")
+        geometry = reward_function.warm_up(params_test['waypoints'])
+        re = RewardEvaluator(params_test)
+        self.assertIs(re.track, geometry)
+        re = RewardEvaluator(get_test_params("params_reinvent2018"))
+        self.assertIs(re.track, geometry)
+        self.assertEqual(geometry.num_waypoints, len(params_test['waypoints']))
+        self.assertEqual(geometry.segment_headings[0],
+                         re.get_heading_between_waypoints(re.get_way_point(0), re.get_way_point(1)))
+        # The last waypoint duplicates the first one - the closing segment ends in the first waypoint
+        self.assertEqual(geometry.segment_lengths[-1],
+                         re.get_way_points_distance(re.get_way_point(-2), re.get_way_point(0)))
+
+    def test_preprocess_waypoints(self):
+        points, index_map, closed = reward_function.preprocess_waypoints(
+            [(0, 0), (1, 0), (1, 0), (2, 0), (2, 2), (0, 2), (0, 0)])
+        self.assertEqual(points, ((0, 0), (1, 0), (2, 0), (2, 2), (0, 2)))
+        self.assertEqual(index_map, (0, 1, 1, 2, 3, 4, 0))
+        self.assertEqual(closed, True)
+        points, index_map, closed = reward_function.preprocess_waypoints([(0, 0), (0, 2), (2, 2), (2, 0)])
+        self.assertEqual(index_map, (0, 1, 2, 3))
+        self.assertEqual(closed, True)
+        points, index_map, closed = reward_function.preprocess_waypoints([(0, 0), (1, 0), (2, 0), (3, 0), (4, 0)])
+        self.assertEqual(closed, False)
+        self.assertRaises(ValueError, reward_function.preprocess_waypoints, [(1, 1), (1, 1), (1, 1)])
+
+    def test_open_track_ends_at_last_waypoint(self):
+        params_test = get_test_params()
+        params_test['waypoints'] = [(0, 0), (1, 0), (2, 0), (3, 0), (4, 0)]
+        params_test['heading'] = 0
+        params_test['y'] = 0
+        # No closing segment back to the start: the track ahead of the end is straight, nothing is behind the start
+        params_test['x'] = 3.5
+        params_test['closest_waypoints'] = [3, 4]
+        re = RewardEvaluator(params_test)
+        self.assertFalse(re.track.closed)
+        self.assertEqual(re.track.track_length, 4)
+        self.assertEqual(re.get_optimum_speed_ratio(), 1.0)
+        params_test['closest_waypoints'] = [4, 0]
+        re = RewardEvaluator(params_test)
+        self.assertEqual(re.get_car_heading_error(), 0)
+        self.assertEqual(re.get_turn_angle(), 0)
+        params_test['x'] = 2.5
+        params_test['closest_waypoints'] = [2, 3]
+        re = RewardEvaluator(params_test)
+        self.assertEqual(re.get_expected_turn_direction(), "STRAIGHT")
+        params_test['x'] = 0.5
+        params_test['closest_waypoints'] = [0, 1]
+        re = RewardEvaluator(params_test)
+        self.assertEqual(re.get_turn_angle(), 0)
+        self.assertFalse(re.is_in_turn())
+
+    def test_duplicated_waypoints_are_repaired(self):
+        params_test = get_test_params()
+        params_test['heading'] = 0
+        params_test['waypoints'] = [(0, 0), (1, 0), (1, 0), (2, 1), (2, 2), (0, 2), (0, 0)]
+        # Zero-length segment 1 -> 2: turn angle and track direction are taken from the next real segment
+        params_test['closest_waypoints'] = [1, 2]
+        re = RewardEvaluator(params_test)
+        self.assertEqual(re.track.removed_waypoints, 2)
+        self.assertEqual(re.get_turn_angle(), 45)
+        self.assertEqual(re.get_car_heading_error(), 45)
+        params_test['closest_waypoints'] = [2, 3]
+        re = RewardEvaluator(params_test)
+        self.assertEqual(re.get_turn_angle(), 45)
+        # Closing duplicate: the last waypoint is the first one
+        params_test['closest_waypoints'] = [6, 0]
+        re = RewardEvaluator(params_test)
+        self.assertEqual(re.get_turn_angle(), 90)
+        self.assertEqual(re.get_car_heading_error(), 0)
+
+    def test_track_geometry_lookup_with_fresh_waypoints_list(self):
+        # The environment may pass a new waypoints list every step - the lookup must neither rebuild the geometry nor
+        # read the whole track (timings are measured by benchmark.py)
+        params_test = get_test_params("BOWTLE")
+        geometry = reward_function.warm_up(params_test['waypoints'])
+        built = []
+        read_waypoints = []
+
+        class CountingTrackGeometry(reward_function.TrackGeometry):
+            def __init__(self, waypoints):
+                built.append(waypoints)
+                reward_function.TrackGeometry.__init__(self, waypoints)
+
+        class CountingList(list):
+            def __getitem__(self, index):
+                read_waypoints.append(index)
+                return list.__getitem__(self, index)
+
+            def __iter__(self):
+                read_waypoints.extend(range(len(self)))
+                return list.__iter__(self)
+
+        original_track_geometry = reward_function.TrackGeometry
+        reward_function.TrackGeometry = CountingTrackGeometry
+        try:
+            for _ in range(20):
+                waypoints = CountingList(copy.deepcopy(params_test['waypoints']))
+                self.assertIs(reward_function.get_track_geometry(waypoints), geometry)
+        finally:
+            reward_function.TrackGeometry = original_track_geometry
+        self.assertEqual(built, [])
+        self.assertLessEqual(len(read_waypoints), 20 * 5)
+
+    def test_known_tracks_are_identified(self):
+        for track_name in ("reInvent2018", "Bowtie"):
+            re = RewardEvaluator(get_test_params(track_name))
+            self.assertEqual(re.track.name, track_name)
+        self.assertEqual(RewardEvaluator(get_test_params()).track.name, "reInvent2018")
+        params_test = get_test_params()
+        params_test['waypoints'] = [(0, 0), (1, 0), (2, 0), (3, 3)]
+        re = RewardEvaluator(params_test)
+        self.assertIsNone(re.track.name)
+        self.assertEqual(re.track.tuning, {})
+
+    def test_track_tuning_is_applied(self):
+        params_test = get_test_params()
+        params_test['waypoints'] = [(0, 0), (1, 0), (2, 0), (3, 3)]
+        params_test['closest_waypoints'] = [0, 1]
+        saved_known_tracks = dict(reward_function.KNOWN_TRACKS)
+        try:
+            reward_function.register_track("TestTrack", params_test['waypoints'], SAFE_HORIZON_DISTANCE=2.5)
+            re = RewardEvaluator(params_test)
+            self.assertEqual(re.track.name, "TestTrack")
+            self.assertEqual(re.SAFE_HORIZON_DISTANCE, 2.5)
+            self.assertEqual(RewardEvaluator.SAFE_HORIZON_DISTANCE, 0.8)
+        finally:
+            reward_function.KNOWN_TRACKS.clear()
+            reward_function.KNOWN_TRACKS.update(saved_known_tracks)
+            reward_function.clear_track_cache()
+        re = RewardEvaluator(params_test)
+        self.assertIsNone(re.track.name)
+        self.assertEqual(re.SAFE_HORIZON_DISTANCE, 0.8)
+
+    def test_track_tuning_does_not_override_subclass(self):
+        class LongHorizonRewardEvaluator(RewardEvaluator):
+            SAFE_HORIZON_DISTANCE = 1.5
+
+        params_test = get_test_params()
+        params_test['waypoints'] = [(0, 0), (1, 0), (2, 0), (3, 3)]
+        params_test['closest_waypoints'] = [0, 1]
+        saved_known_tracks = dict(reward_function.KNOWN_TRACKS)
+        try:
+            reward_function.register_track("TestTrack", params_test['waypoints'], SAFE_HORIZON_DISTANCE=2.5,
+                                           ANGLE_IS_CURVE=5)
+            re = LongHorizonRewardEvaluator(params_test)
+            re.evaluate()
+            self.assertEqual(re.track.name, "TestTrack")
+            self.assertEqual(re.SAFE_HORIZON_DISTANCE, 1.5)
+            self.assertEqual(re.ANGLE_IS_CURVE, 5)
+            self.assertEqual(RewardEvaluator(params_test).SAFE_HORIZON_DISTANCE, 2.5)
+        finally:
+            reward_function.KNOWN_TRACKS.clear()
+            reward_function.KNOWN_TRACKS.update(saved_known_tracks)
+            reward_function.clear_track_cache()
+
+    def test_step_recorder_ring_buffer(self):
+        with tempfile.TemporaryDirectory() as directory:
+            recorder = StepRecorder(4, directory)
+            params_test = get_test_params()
+            for steps in range(1, 11):
+                params_test['steps'] = steps
+                params_test['x'] = float(steps)
+                recorder.record(params_test, 100.0, 2)
+            self.assertEqual(recorder.dumped_files, [])
+            params_test['steps'] = 11
+            params_test['x'] = 11.0
+            params_test['all_wheels_on_track'] = False
+            recorder.record(params_test, 0.001, 1)
+            self.assertEqual(len(recorder.dumped_files), 1)
+            trigger, columns = StepRecorder.load(recorder.dumped_files[0])
+            self.assertEqual(trigger, StepRecorder.TRIGGER_OFF_TRACK)
+            self.assertEqual(columns['steps'], [8, 9, 10, 11])
+            self.assertEqual(columns['x'], [8.0, 9.0, 10.0, 11.0])
+            self.assertEqual(columns['features'], [2, 2, 2, 1])
+            # One dump per episode only
+            params_test['steps'] = 12
+            recorder.record(params_test, 0.001, 1)
+            self.assertEqual(len(recorder.dumped_files), 1)
+
+    def test_step_recorder_one_step_episodes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            recorder = StepRecorder(10, directory)
+            params_test = get_test_params()
+            params_test['all_wheels_on_track'] = False
+            params_test['steps'] = 1.0  # steps may come as a float
+            recorder.record(params_test, 0.001)
+            params_test['all_wheels_on_track'] = True
+            params_test['steps'] = 1
+            recorder.record(params_test, 100.0)
+            self.assertEqual(recorder.count, 1)
+            params_test['all_wheels_on_track'] = False
+            params_test['steps'] = 2.0
+            recorder.record(params_test, 0.001)
+            self.assertEqual(len(recorder.dumped_files), 2)
+            trigger, columns = StepRecorder.load(recorder.dumped_files[1])
+            self.assertEqual((trigger, columns['steps']), (StepRecorder.TRIGGER_OFF_TRACK, [1, 2]))
+
+    def test_step_recorder_triggers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            recorder = StepRecorder(100, directory, low_progress=50.0)
+            params_test = get_test_params()
+            params_test['progress'] = 10.0
+            for steps in (1, 2, 3, 1):  # the episode ended with 10% progress
+                params_test['steps'] = steps
+                recorder.record(params_test, 100.0)
+            self.assertEqual(len(recorder.dumped_files), 1)
+            trigger, columns = StepRecorder.load(recorder.dumped_files[0])
+            self.assertEqual((trigger, columns['steps']), (StepRecorder.TRIGGER_LOW_PROGRESS, [1, 2, 3]))
+            params_test['steps'] = 2
+            recorder.record(params_test, float('nan'))
+            trigger, columns = StepRecorder.load(recorder.dumped_files[1])
+            self.assertEqual((trigger, columns['steps']), (StepRecorder.TRIGGER_REWARD_ANOMALY, [1, 2]))
+            params_test['steps'] = 1
+            params_test['progress'] = 100.0
+            recorder.record(params_test, 100.0)
+            params_test['is_reversed'] = True
+            params_test['steps'] = 2
+            recorder.record(params_test, 0.001)
+            self.assertEqual(StepRecorder.load(recorder.dumped_files[2])[0], StepRecorder.TRIGGER_REVERSED)
+
+    def test_reward_function_records_steps(self):
+        with tempfile.TemporaryDirectory() as directory:
+            reward_function.step_recorder = StepRecorder(10, directory)
+            try:
+                params_test = get_test_params()
+                params_test['all_wheels_on_track'] = False
+                reward_function.reward_function(params_test)
+            finally:
+                recorder, reward_function.step_recorder = reward_function.step_recorder, None
+            trigger, columns = StepRecorder.load(recorder.dumped_files[0])
+            self.assertEqual(columns['reward'], [RewardEvaluator.PENALTY_MAX])
+            self.assertEqual(columns['features'], [1])
+
+    def get_cache_test_params(self):
+        params_test = get_test_params()
+        params_test['heading'] = 0
+        params_test['distance_from_center'] = 0.01
+        params_test['steering_angle'] = 0
+        params_test['speed'] = 5.0
+        params_test['closest_waypoints'] = [0, 1]
+        params_test['x'] = params_test['waypoints'][0][0]
+        params_test['y'] = params_test['waypoints'][0][1]
+        return params_test
+
+    def test_reward_cache_hits(self):
+        cache = RewardCache(verify_every=1)
+        params_test = self.get_cache_test_params()
+        expected = RewardEvaluator(params_test).evaluate()
+        self.assertEqual(cache.evaluate(RewardEvaluator(params_test)), expected)
+        # Same quantized state - a little different lateral offset, heading and position
+        params_test['distance_from_center'] = 0.02
+        params_test['heading'] = -0.5
+        params_test['x'] = params_test['x'] + 0.001
+        re = RewardEvaluator(params_test)
+        self.assertEqual(cache.evaluate(re), expected)
+        self.assertEqual(re.features, RewardEvaluator.FEATURE_BITS["getCarHeadingOK"] |
+                         RewardEvaluator.FEATURE_BITS["getSteeringAngleOK"] |
+                         RewardEvaluator.FEATURE_BITS["is_in_optimized_corridor"] |
+                         RewardEvaluator.FEATURE_BITS["isStraightOnMaxSpeed"])
+        # Different action - a new entry
+        params_test['speed'] = 3.33
+        cache.evaluate(RewardEvaluator(params_test))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (1, 2, 2))
+        self.assertEqual((stats['verified'], stats['max_reward_error']), (1, 0.0))
+        self.assertAlmostEqual(cache.hit_ratio(), 1 / 3.0)
+
+    def test_reward_cache_respects_thresholds(self):
+        cache = RewardCache(heading_bucket=90.0)
+        params_test = self.get_cache_test_params()
+        params_test['heading'] = RewardEvaluator.SMOOTH_STEERING_ANGLE_TRESHOLD - 0.1
+        smooth = cache.evaluate(RewardEvaluator(params_test))
+        params_test['heading'] = RewardEvaluator.SMOOTH_STEERING_ANGLE_TRESHOLD + 0.1
+        not_smooth = cache.evaluate(RewardEvaluator(params_test))
+        self.assertEqual(cache.misses, 2)
+        self.assertEqual(not_smooth, RewardEvaluator(params_test).evaluate())
+        self.assertNotEqual(smooth, not_smooth)
+
+    def test_reward_cache_speed_thresholds(self):
+        # 4.504 and 4.496 round to the same speed, but only the first one is within 10% of MAX_SPEED
+        cache = RewardCache()
+        params_test = self.get_cache_test_params()
+        for speed in (4.504, 4.496):
+            params_test['speed'] = speed
+            self.assertEqual(cache.evaluate(RewardEvaluator(params_test)), RewardEvaluator(params_test).evaluate())
+        self.assertEqual(cache.misses, 2)
+
+    def test_reward_cache_hits_are_exact(self):
+        # Jittered states around a few hundred base states along the whole track - the positions cross the horizon
+        # breakpoints, speeds and steering angles vary within the rounding
+        rng = random.Random(3)
+        base_params = get_test_params("reInvent2018")
+        waypoints = base_params['waypoints']
+        base_states = []
+        for _ in range(150):
+            index = rng.randrange(len(waypoints) - 1)
+            position = rng.random()
+            base_states.append((index, position, rng.uniform(-25, 25), rng.choice((1.67, 3.33, 4.5, 5.0)),
+                                rng.choice((-30, -15, 0, 15, 30)), rng.uniform(0, 0.3), rng.random() < 0.5,
+                                rng.randint(1, 300)))
+        cache = RewardCache(verify_every=1)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(3000):
+                index, position, heading, speed, steering, offset, left, steps = rng.choice(base_states)
+                prev_point = waypoints[index]
+                next_point = waypoints[index + 1]
+                params_test = dict(base_params)
+                params_test.update({
+                    "x": prev_point[0] + position * (next_point[0] - prev_point[0]) + rng.uniform(-0.03, 0.03),
+                    "y": prev_point[1] + position * (next_point[1] - prev_point[1]) + rng.uniform(-0.03, 0.03),
+                    "heading": math.degrees(math.atan2(next_point[1] - prev_point[1], next_point[0] - prev_point[0]))
+                    + heading + rng.uniform(-1, 1),
+                    "speed": speed + rng.uniform(-0.004, 0.004),
+                    "steering_angle": steering + rng.uniform(-0.004, 0.004),
+                    "distance_from_center": offset,
+                    "is_left_of_center": left,
+                    "steps": steps,
+                    "closest_waypoints": [index, index + 1],
+                })
+                cache.evaluate(RewardEvaluator(params_test))
+        self.assertGreater(cache.hit_ratio(), 0.5)
+        self.assertEqual(cache.verified, cache.hits)
+        self.assertEqual(cache.max_reward_error, 0.0)
+
+    def test_reward_cache_does_not_keep_fallbacks(self):
+        cache = RewardCache()
+        params_test = self.get_cache_test_params()
+        re = RewardEvaluator(params_test)
+        re.guard = LatencyGuard(time_budget=-1.0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(cache.evaluate(re), RewardEvaluator.PENALTY_MAX)
+        self.assertEqual(len(cache.entries), 0)
+        self.assertEqual(cache.evaluate(RewardEvaluator(params_test)), RewardEvaluator(params_test).evaluate())
+
+    def test_reward_cache_lru_eviction(self):
+        cache = RewardCache(max_size=2)
+        params_test = self.get_cache_test_params()
+        for speed in (3.0, 4.0, 3.0, 5.0, 4.0):
+            params_test['speed'] = speed
+            cache.evaluate(RewardEvaluator(params_test))
+        # 3.0 was used recently when 5.0 came, so 4.0 was evicted and evaluated again
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (1, 4, 2))
+        self.assertEqual([key[6] for key in cache.entries], [5.0, 4.0])
+
+    def test_reward_function_uses_cache(self):
+        reward_function.reward_cache = RewardCache()
+        try:
+            params_test = self.get_cache_test_params()
+            first = reward_function.reward_function(params_test)
+            second = reward_function.reward_function(self.get_cache_test_params())
+        finally:
+            cache, reward_function.reward_cache = reward_function.reward_cache, None
+        self.assertEqual(first, second)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def get_tiny_track_params(self, size):
+        params_test = self.get_cache_test_params()
+        params_test['waypoints'] = [(0, 0), (size, 0), (size, size), (0, size)]
+        params_test['x'] = 0
+        params_test['y'] = 0
+        params_test['track_width'] = size
+        return params_test
+
+    def test_horizon_walk_work_budget(self):
+        re = RewardEvaluator(self.get_tiny_track_params(0.0001))
+        self.assertRaises(BudgetExceeded, re.get_optimum_speed_ratio)
+        self.assertRaises(BudgetExceeded, re.get_expected_turn_direction)
+        re = RewardEvaluator(self.get_tiny_track_params(0.01))  # 80 segments to walk is fine
+        self.assertIn(re.get_optimum_speed_ratio(), (0.33, 0.66, 1.0))
+        self.assertIn(re.get_expected_turn_direction(), ("LEFT", "RIGHT", "STRAIGHT"))
+
+    def test_error_logging_is_rate_limited(self):
+        reward_function._error_log_state.update(last_time=None, suppressed=0)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            for _ in range(5):
+                reward = RewardEvaluator(self.get_tiny_track_params(0.0001)).evaluate()
+        self.assertGreater(reward, RewardEvaluator.PENALTY_MAX)  # rewards collected before the failure are kept
+        self.assertEqual(output.getvalue().count("Error : "), 1)
+        self.assertEqual(reward_function._error_log_state["suppressed"], 4)
+        reward_function._error_log_state.update(last_time=None)
+        with contextlib.redirect_stdout(output):
+            RewardEvaluator(self.get_tiny_track_params(0.0001)).evaluate()
+        self.assertIn("(4 similar errors not logged)", output.getvalue())
+
+    def test_latency_guard_fallback(self):
+        guard = LatencyGuard()
+        params_test = self.get_cache_test_params()
+        re = RewardEvaluator(params_test)
+        re.guard = guard
+        good_reward = re.evaluate()
+        self.assertEqual(good_reward, RewardEvaluator(params_test).evaluate())
+        # The same waypoint, the evaluation is out of time budget - the last good reward is returned
+        guard.time_budget = -1.0
+        with contextlib.redirect_stdout(io.StringIO()):
+            re = RewardEvaluator(params_test)
+            re.guard = guard
+            self.assertEqual(re.evaluate(), good_reward)
+            self.assertTrue(re.features & RewardEvaluator.FEATURE_BITS["fallback"])
+            # No good reward at this waypoint yet
+            params_test['closest_waypoints'] = [5, 6]
+            re = RewardEvaluator(params_test)
+            re.guard = guard
+            self.assertEqual(re.evaluate(), RewardEvaluator.PENALTY_MAX)
+            # An exception
+            params_test['steering_angle'] = None
+            guard.time_budget = 1.0
+            re = RewardEvaluator(params_test)
+            re.guard = guard
+            self.assertEqual(re.evaluate(), RewardEvaluator.PENALTY_MAX)
+        self.assertEqual(guard.stats(), {"evaluations": 4, "budget_exceeded": 2, "errors": 1, "fallbacks": 3,
+                                         "slow": 0})
+
+    def test_reward_function_uses_latency_guard(self):
+        reward_function.latency_guard = LatencyGuard()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                reward = reward_function.reward_function(self.get_tiny_track_params(0.0001))
+        finally:
+            guard, reward_function.latency_guard = reward_function.latency_guard, None
+        self.assertEqual(reward, RewardEvaluator.PENALTY_MAX)
+        self.assertEqual(guard.budget_exceeded, 1)
+
+    def run_guarded_pipeline(self, params_test, **components):
+        saved = dict((name, getattr(reward_function, name)) for name in components)
+        for name, component in components.items():
+            setattr(reward_function, name, component)
+        reward_function.latency_guard = LatencyGuard(time_budget=1.0)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                reward = reward_function.reward_function(params_test)
+        finally:
+            guard, reward_function.latency_guard = reward_function.latency_guard, None
+            for name, component in saved.items():
+                setattr(reward_function, name, component)
+        return reward, guard
+
+    def test_latency_guard_covers_whole_step(self):
+        params_test = self.get_cache_test_params()
+        params_test['steering_angle'] = None
+        for components in ({}, {"reward_cache": RewardCache()}, {"rolling_features": RollingFeatures()},
+                           {"reward_cache": RewardCache(), "rolling_features": RollingFeatures(),
+                            "step_recorder": StepRecorder(10, tempfile.gettempdir())}):
+            reward, guard = self.run_guarded_pipeline(dict(params_test), **components)
+            self.assertEqual(reward, RewardEvaluator.PENALTY_MAX)
+            self.assertEqual((guard.errors, guard.fallbacks), (1, 1))
+            if "rolling_features" in components:
+                self.assertEqual(components["rolling_features"].count, 0)  # the invalid step did not change the state
+        # A degenerate track fails already when the evaluator is created
+        params_test = self.get_cache_test_params()
+        params_test['waypoints'] = [(1.0, 1.0)] * 4
+        reward, guard = self.run_guarded_pipeline(params_test)
+        self.assertEqual(reward, RewardEvaluator.PENALTY_MAX)
+        self.assertEqual(guard.errors, 1)
+        # Without the guard the errors are raised as before
+        self.assertRaises(ValueError, reward_function.reward_function, params_test)
+
+    def test_latency_guard_falls_back_to_last_good_reward_with_cache(self):
+        params_test = self.get_cache_test_params()
+        reward_cache = RewardCache()
+        good_reward, guard = self.run_guarded_pipeline(dict(params_test), reward_cache=reward_cache)
+        params_test['speed'] = None
+        reward_function.latency_guard = guard
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                reward_function.reward_cache = reward_cache
+                reward = reward_function.reward_function(params_test)
+        finally:
+            reward_function.latency_guard = None
+            reward_function.reward_cache = None
+        self.assertEqual(reward, good_reward)
+        self.assertEqual(guard.fallbacks, 1)
+
+    @staticmethod
+    def get_rolling_columns(episodes, seed=0):
+        rng = random.Random(seed)
+        columns = {"steps": [], "progress": [], "steering_angle": [], "speed": [], "heading_error": []}
+        for episode in range(episodes):
+            progress = 0.0
+            for steps in range(1, rng.randint(2, 120)):
+                progress = progress + rng.uniform(0.0, 1.5)
+                columns["steps"].append(steps)
+                columns["progress"].append(progress)
+                columns["steering_angle"].append(rng.choice((-30.0, -15.0, 0.0, 15.0, 30.0)))
+                columns["speed"].append(rng.uniform(1.0, 5.0))
+                columns["heading_error"].append(rng.uniform(-40.0, 40.0))
+        return columns
+
+    def test_rolling_features_statistics(self):
+        rolling = RollingFeatures(window=4, alpha=0.5)
+        for steps in range(1, 11):
+            rolling.update(steps, steps * 2.0, 10.0 if steps % 2 else -10.0, 1.0 + 0.25 * steps, 30.0 - steps)
+        self.assertAlmostEqual(rolling.progress_rate, 2.0)
+        self.assertAlmostEqual(rolling.steering_variance, 100.0)
+        self.assertAlmostEqual(rolling.speed_trend, 0.25)
+        self.assertAlmostEqual(rolling.heading_error_trend, -1.0)
+        # EMA of a linearly growing speed lags by slope * (1 - alpha) / alpha behind the last speed
+        self.assertAlmostEqual(rolling.speed_ema, 3.5 - 0.25, places=2)
+        # A new episode (steps going backwards) starts from scratch
+        rolling.update(1, 0.5, 0.0, 2.0, -5.0)
+        self.assertEqual(rolling.count, 1)
+        self.assertEqual(rolling.values(), {"progress_rate": 0.5, "progress_rate_ema": 0.5, "steering_variance": 0.0,
+                                            "speed_trend": 0.0, "speed_ema": 2.0, "heading_error_trend": 0.0,
+                                            "heading_error_ema": 5.0})
+
+    def test_rolling_features_online_matches_bulk(self):
+        columns = self.get_rolling_columns(20)
+        rolling = RollingFeatures(window=10, alpha=0.2)
+        online = dict((name, []) for name in RollingFeatures.FEATURES)
+        for values in zip(columns["steps"], columns["progress"], columns["steering_angle"], columns["speed"],
+                          columns["heading_error"]):
+            for name, value in rolling.update(*values).values().items():
+                online[name].append(value)
+        offline = RollingFeatures(window=10, alpha=0.2).bulk(columns["steps"], columns["progress"],
+                                                             columns["steering_angle"], columns["speed"],
+                                                             columns["heading_error"])
+        self.assertEqual(online, offline)
+
+    def test_rolling_features_update_does_not_depend_on_window(self):
+        # Every update reads and writes a fixed number of history entries whatever the window (its time is measured
+        # by benchmark.py)
+        columns = self.get_rolling_columns(20)
+        rows = list(zip(columns["steps"], columns["progress"], columns["steering_angle"], columns["speed"],
+                        columns["heading_error"]))
+        accessed = []
+
+        class CountingHistory(list):
+            def __getitem__(self, index):
+                accessed.append(index)
+                return list.__getitem__(self, index)
+
+            def __setitem__(self, index, value):
+                accessed.append(index)
+                list.__setitem__(self, index, value)
+
+        for window in (5, 1000):
+            rolling = RollingFeatures(window)
+            rolling.history = CountingHistory(rolling.history)
+            for values in rows:
+                del accessed[:]
+                rolling.update(*values)
+                # reset on a new episode, one row written, one row read
+                self.assertLessEqual(len(accessed), 2 * RollingFeatures.NUM_SUMS + 1)
+            expected = RollingFeatures(window).bulk(*[columns[name] for name in
+                                                      ("steps", "progress", "steering_angle", "speed", "heading_error")])
+            self.assertEqual(rolling.values(), dict((name, values[-1]) for name, values in expected.items()))
+
+    def test_reward_function_updates_rolling_features(self):
+        params_test = get_test_params()
+        reward_function.rolling_features = RollingFeatures()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                for steps in (1, 2, 3):
+                    params_test['steps'] = steps
+                    params_test['progress'] = steps * 0.5
+                    reward = reward_function.reward_function(dict(params_test))
+                    self.assertEqual(reward, RewardEvaluator(dict(params_test)).evaluate())
+        finally:
+            rolling, reward_function.rolling_features = reward_function.rolling_features, None
+        self.assertEqual(rolling.count, 3)
+        self.assertAlmostEqual(rolling.progress_rate, 0.5)
+
+    def test_import_is_dependency_free(self):
+        # Only "math" is imported up front (the import time is measured by benchmark.py)
+        code = ("import sys\n"
+                "import reward_function\n"
+                "print(' '.join(m for m in ('numpy', 'traceback', 'sqlite3', 'zlib', 'array', 'collections')"
+                " if m in sys.modules))\n")
+        source_dir = os.path.dirname(os.path.abspath(reward_function.__file__))
+        output = subprocess.check_output([sys.executable, "-S", "-c", code], cwd=source_dir).decode().split()
+        self.assertEqual(output, [])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the differential harness in ../reward_equivalence.py comparing the reference and optimized RewardEvaluator.
+"""
+
+import unittest
+
+from parms.parms import get_copy_of_params as get_test_params
+from reward_equivalence import ReferenceRewardEvaluator, find_difference, normalize_track, random_params, run
+from reward_function import RewardEvaluator
+
+
+# Deliberately wrong optimization - the +-180 degrees wrap of the turn angle is missing
+class NoWrapRewardEvaluator(RewardEvaluator):
+
+    def get_turn_angle(self):
+        segment_headings = self.track.segment_headings
+        current_waypoint = self.closest_waypoints[0] % self.track.num_waypoints
+        return segment_headings[current_waypoint] - segment_headings[current_waypoint - 1]
+
+
+def get_bundled_tracks():
+    return {"reinvent2018": normalize_track(get_test_params("params_reinvent2018")),
+            "bowtie": normalize_track(get_test_params("BOWTLE"))}
+
+
+def get_bundled_waypoints_count():
+    return sum(len(params['waypoints']) for params in get_bundled_tracks().values())
+
+
+class RewardEquivalenceTestCase(unittest.TestCase):
+
+    def test_random_params_are_reproducible(self):
+        params_test = get_test_params("params_reinvent2018")
+        self.assertEqual(random_params(params_test, 5, 7), random_params(params_test, 5, 7))
+        self.assertNotEqual(random_params(params_test, 5, 7), random_params(params_test, 5, 8))
+        self.assertEqual(random_params(params_test, 70, 1)['closest_waypoints'], [70, 0])
+
+    def test_normalized_track_has_no_duplicated_waypoints(self):
+        params_test = normalize_track(get_test_params("params_reinvent2018"))
+        self.assertEqual(len(params_test['waypoints']), 70)
+        self.assertNotEqual(params_test['waypoints'][0], params_test['waypoints'][-1])
+
+    def test_optimized_evaluator_matches_reference(self):
+        checked, divergence = run(get_bundled_tracks(), RewardEvaluator, seeds=5, processes=1)
+        self.assertIsNone(divergence)
+        self.assertEqual(checked, 5 * get_bundled_waypoints_count())
+
+    def test_process_pool(self):
+        checked, divergence = run(get_bundled_tracks(), RewardEvaluator, seeds=4, processes=2, chunk_size=2)
+        self.assertIsNone(divergence)
+        self.assertEqual(checked, 4 * get_bundled_waypoints_count())
+
+    def test_divergence_is_reported_minimized(self):
+        checked, divergence = run(get_bundled_tracks(), NoWrapRewardEvaluator, seeds=5, processes=1)
+        self.assertIsNotNone(divergence)
+        self.assertEqual(divergence.method, "get_turn_angle")
+        self.assertNotEqual(divergence.expected, divergence.actual)
+        self.assertEqual(divergence.params['steps'], 1)
+        self.assertEqual(divergence.params['steering_angle'], 0)
+        difference = find_difference(divergence.params, NoWrapRewardEvaluator, ReferenceRewardEvaluator)
+        self.assertEqual(difference[0], "get_turn_angle")
+
+    def test_reference_is_independent_of_optimized_evaluator(self):
+        self.assertFalse(issubclass(ReferenceRewardEvaluator, RewardEvaluator))
+
+    def test_degenerate_track_does_not_hang(self):
+        params_test = get_test_params("params_reinvent2018")
+        params_test['waypoints'] = [(1.0, 1.0)] * 5
+        params_test['closest_waypoints'] = [0, 1]
+        difference = find_difference(params_test, RewardEvaluator)
+        self.assertIsNotNone(difference)
+        self.assertEqual(difference[0], "get_car_heading_error")
+        self.assertEqual(difference[2], "raised ValueError")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the multi-variant reward evaluation in ../reward_variants.py.
+"""
+
+import contextlib
+import io
+import unittest
+
+import reward_function
+from parms.parms import get_copy_of_params as get_test_params
+from reward_equivalence import normalize_track, random_params
+from reward_function import RewardEvaluator
+from reward_variants import MultiVariantEvaluator, RewardVariant
+
+
+class SmootherRewardEvaluator(RewardEvaluator):
+    SMOOTH_STEERING_ANGLE_TRESHOLD = 10
+    REWARD_MAX = 1000
+
+
+def get_replay_params(seeds=3):
+    params_list = []
+    for track_name in ("reInvent2018", "Bowtie"):
+        base_params = normalize_track(get_test_params(track_name))
+        for seed in range(seeds):
+            for waypoint_index in range(len(base_params['waypoints'])):
+                params_list.append(random_params(base_params, waypoint_index, seed))
+    return params_list
+
+
+# A car driving straight at max speed on a tiny track - the horizon walk exceeds its budget in the corridor check, the
+# heading and steering terms are earned before
+def get_error_path_params():
+    params_test = get_test_params()
+    params_test['waypoints'] = [(0, 0), (0.0001, 0), (0.0001, 0.0001), (0, 0.0001)]
+    params_test.update({"heading": 0, "steering_angle": 0, "speed": 5.0, "distance_from_center": 0.01, "x": 0, "y": 0,
+                        "track_width": 0.0001, "closest_waypoints": [0, 1]})
+    return params_test
+
+
+def evaluate_quietly(evaluator_class, params):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return evaluator_class(dict(params)).evaluate()
+
+
+class RewardVariantsTestCase(unittest.TestCase):
+
+    def test_variants_match_evaluate(self):
+        params_list = get_replay_params()
+        evaluator = MultiVariantEvaluator([RewardVariant("default"),
+                                           RewardVariant("smoother", smooth_heading_threshold=10,
+                                                         smooth_steering_threshold=10, reward_max=1000)])
+        params_list.append(get_error_path_params())
+        columns = evaluator.evaluate_all(params_list)
+        self.assertEqual(columns["default"][-1], 40499.551)
+        self.assertEqual(columns["default"], [evaluate_quietly(RewardEvaluator, params) for params in params_list])
+        self.assertEqual(columns["smoother"],
+                         [evaluate_quietly(SmootherRewardEvaluator, params) for params in params_list])
+
+    def test_default_variant_follows_evaluator_constants(self):
+        params_list = get_replay_params(1)
+        columns = MultiVariantEvaluator([RewardVariant("default")], SmootherRewardEvaluator).evaluate_all(params_list)
+        self.assertEqual(columns["default"],
+                         [evaluate_quietly(SmootherRewardEvaluator, params) for params in params_list])
+
+    def test_default_variant_follows_track_tuning(self):
+        params_list = get_replay_params(1)
+        saved_known_tracks = dict(reward_function.KNOWN_TRACKS)
+        try:
+            reward_function.register_track("TunedBowtie", params_list[-1]['waypoints'], REWARD_MAX=1000,
+                                           SMOOTH_STEERING_ANGLE_TRESHOLD=10)
+            columns = MultiVariantEvaluator([RewardVariant("default")]).evaluate_all(params_list)
+            expected = [evaluate_quietly(RewardEvaluator, params) for params in params_list]
+        finally:
+            reward_function.KNOWN_TRACKS.clear()
+            reward_function.KNOWN_TRACKS.update(saved_known_tracks)
+            reward_function.clear_track_cache()
+        self.assertEqual(columns["default"], expected)
+        self.assertIn(1000.001, expected)
+
+    def test_custom_formula_and_switched_off_branch(self):
+        params_test = get_test_params()
+        params_test['heading'] = 0
+        params_test['steering_angle'] = 0
+        params_test['speed'] = 5.0
+        params_test['distance_from_center'] = 0
+        params_test['closest_waypoints'] = [0, 1]
+        params_test['x'] = params_test['waypoints'][0][0]
+        params_test['y'] = params_test['waypoints'][0][1]
+
+        def heading_only(features):
+            return 1.0 if abs(features.heading_error) < 1 else 0.0
+
+        evaluator = MultiVariantEvaluator([RewardVariant("default"), RewardVariant("no_steering", steering_weight=0),
+                                           heading_only])
+        default, no_steering, heading = evaluator.evaluate(params_test)
+        self.assertEqual(default, RewardEvaluator(params_test).evaluate())
+        self.assertAlmostEqual(default - no_steering, RewardEvaluator.REWARD_MAX * 0.15)
+        self.assertEqual(heading, 1.0)
+        self.assertEqual(evaluator.names, ["default", "no_steering", "heading_only"])
+
+    def test_unknown_parameter(self):
+        self.assertRaises(ValueError, RewardVariant, "typo", heading_wieght=1)
+
+    def test_features_are_calculated_once_per_step(self):
+        # The cost of many variants is the feature calculation of one (timings are measured by benchmark.py)
+        calculated = []
+
+        class CountingRewardEvaluator(RewardEvaluator):
+            def __init__(self, params):
+                calculated.append(params['closest_waypoints'][0])
+                RewardEvaluator.__init__(self, params)
+
+        params_list = get_replay_params(1)
+        variants = [RewardVariant("v" + str(index), heading_weight=index / 20.0) for index in range(20)]
+        columns = MultiVariantEvaluator(variants, CountingRewardEvaluator).evaluate_all(params_list)
+        self.assertEqual(len(columns), 20)
+        self.assertEqual(len(calculated), len(params_list))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the sharded replay coordinator in ../sweep_coordinator.py - several worker processes share one queue file.
+"""
+
+import multiprocessing
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import sweep_coordinator
+from parms.parms import get_copy_of_params as get_test_params
+from sweep_coordinator import (DONE, FAILED, LEASED, PENDING, ReplayAggregate, SweepQueue, make_shards, merge_results,
+                               replay_shard, run_worker)
+from test_trace_archive import generate_trace_lines
+from trace_archive import parse_trace_log, write_archive
+
+CONFIGURATIONS = [{"name": "default", "constants": {}},
+                  {"name": "smoother", "constants": {"SMOOTH_STEERING_ANGLE_TRESHOLD": 10, "REWARD_MAX": 1000}}]
+
+
+def get_track():
+    params_test = get_test_params("reInvent2018")
+    return {"waypoints": params_test['waypoints'][:-1], "track_width": params_test['track_width']}
+
+
+# Claims one shard, reports a partial aggregate and dies without completing or failing it
+# Evaluator taking 50 ms at the start of every episode - replaying 24 episodes takes much longer than a short lease
+class SlowEvaluator(sweep_coordinator.RewardEvaluator):
+
+    def evaluate(self):
+        if self.steps == 1:
+            time.sleep(0.05)
+        return super().evaluate()
+
+
+def crash_after_claim(queue_path, lease_seconds):
+    queue = SweepQueue(queue_path, lease_seconds)
+    shard = queue.claim("crashing-worker")
+    queue.report_partial(shard.id, "crashing-worker", 0, ReplayAggregate(steps=1000000).to_dict())
+    os._exit(1)
+
+
+class SweepCoordinatorTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.archive_path = os.path.join(cls.directory.name, "training.dta")
+        write_archive(cls.archive_path, parse_trace_log(generate_trace_lines(24, seed=3)))
+        cls.expected = {}
+        for configuration in CONFIGURATIONS:
+            payload = make_shards(cls.archive_path, get_track(), [configuration], episodes_per_shard=1000)[0]
+            cls.expected[configuration["name"]] = ReplayAggregate().merge(list(replay_shard(payload, 1000))[0])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def setUp(self):
+        self.queue_path = os.path.join(self.directory.name, self.id() + ".db")
+        self.queue = SweepQueue(self.queue_path, lease_seconds=1.0)
+
+    def tearDown(self):
+        self.queue.close()
+
+    def assertResultsExpected(self, results):
+        self.assertEqual(sorted(results), sorted(self.expected))
+        for name, expected in self.expected.items():
+            self.assertEqual(results[name].episodes, 24)
+            self.assertEqual(results[name].steps, expected.steps)
+            self.assertAlmostEqual(results[name].reward_sum, expected.reward_sum, delta=1e-9 * expected.reward_sum)
+            self.assertEqual(results[name].reward_min, expected.reward_min)
+            self.assertEqual(results[name].reward_max, expected.reward_max)
+
+    def run_workers(self, count, **kwargs):
+        workers = [multiprocessing.Process(target=run_worker, args=(self.queue_path, "worker-" + str(index)),
+                                           kwargs=dict(kwargs, lease_seconds=1.0, poll_interval=0.1))
+                   for index in range(count)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(60)
+            self.assertEqual(worker.exitcode, 0)
+
+    def test_workers_match_serial_replay(self):
+        self.queue.publish(make_shards(self.archive_path, get_track(), CONFIGURATIONS, episodes_per_shard=5))
+        self.run_workers(3, partial_episodes=2)
+        self.assertEqual(self.queue.counts(), {PENDING: 0, LEASED: 0, DONE: 10, FAILED: 0})
+        self.assertResultsExpected(merge_results(self.queue_path))
+
+    def test_crashed_worker_shard_is_retried(self):
+        self.queue.publish(make_shards(self.archive_path, get_track(), CONFIGURATIONS, episodes_per_shard=8))
+        crashing = multiprocessing.Process(target=crash_after_claim, args=(self.queue_path, 1.0))
+        crashing.start()
+        crashing.join(60)
+        self.assertEqual(crashing.exitcode, 1)
+        self.assertEqual(self.queue.counts()[LEASED], 1)
+        self.run_workers(2)
+        self.assertEqual(self.queue.counts()[DONE], 6)
+        self.assertResultsExpected(merge_results(self.queue_path))
+
+    def test_lost_lease_is_not_merged(self):
+        self.queue.publish(make_shards(self.archive_path, get_track(), CONFIGURATIONS[:1], episodes_per_shard=24))
+        shard = self.queue.claim("slow-worker")
+        self.assertTrue(self.queue.renew(shard.id, "slow-worker"))
+        time.sleep(1.1)
+        taken_over = self.queue.claim("other-worker")
+        self.assertEqual((taken_over.id, taken_over.attempts), (shard.id, 2))
+        self.assertFalse(self.queue.report_partial(shard.id, "slow-worker", 0, ReplayAggregate(steps=1).to_dict()))
+        self.assertFalse(self.queue.complete(shard.id, "slow-worker"))
+        self.assertTrue(self.queue.complete(taken_over.id, "other-worker"))
+        self.assertEqual(merge_results(self.queue_path), {})
+
+    def test_lease_is_renewed_during_long_batch(self):
+        self.queue.publish(make_shards(self.archive_path, get_track(), CONFIGURATIONS[:1], episodes_per_shard=24))
+        with mock.patch.object(sweep_coordinator, "RewardEvaluator", SlowEvaluator):
+            start = time.time()
+            completed = run_worker(self.queue_path, "slow-worker", lease_seconds=0.3, partial_episodes=24, wait=False)
+            self.assertGreater(time.time() - start, 0.6)
+        self.assertEqual(completed, 1)
+        self.assertEqual(self.queue.counts()[DONE], 1)
+        self.assertEqual(self.queue.claim("other-worker"), None)
+        result = merge_results(self.queue_path)["default"]
+        self.assertEqual((result.episodes, result.steps), (24, self.expected["default"].steps))
+
+    def test_failing_shard_is_given_up(self):
+        payload = make_shards(self.archive_path, get_track(), CONFIGURATIONS[:1], episodes_per_shard=24)[0]
+        payload["archive"] = os.path.join(self.directory.name, "missing.dta")
+        shard_id = self.queue.publish([payload])[0]
+        self.assertEqual(run_worker(self.queue_path, "worker", max_attempts=2, wait=False), 0)
+        self.assertEqual(self.queue.counts()[FAILED], 1)
+        self.assertIn("FileNotFoundError", self.queue.errors()[shard_id])
+
+    def test_unknown_constant(self):
+        self.assertRaises(ValueError, make_shards, self.archive_path, get_track(),
+                          [{"name": "typo", "constants": {"REWARD_MAXIMUM": 1}}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the compressed trace archive in ../trace_archive.py.
+"""
+
+import math
+import os
+import random
+import tempfile
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from parms.parms import get_copy_of_params as get_test_params
+from trace_archive import COLUMNS, COLUMN_INDEX, TraceArchive, parse_trace_line, parse_trace_log, write_archive
+
+
+# Generates SIM_TRACE_LOG lines of a car driving along the reInvent2018 track (smooth movement as in the real log)
+def generate_trace_lines(episodes, seed=0):
+    waypoints = get_test_params("reInvent2018")['waypoints'][:-1]
+    num_waypoints = len(waypoints)
+    rng = random.Random(seed)
+    time = 1566810937.3542686
+    for episode in range(episodes):
+        waypoint = rng.randrange(num_waypoints)
+        position = 0.0
+        progress = 0.0
+        action = rng.randrange(10)
+        for steps in range(1, rng.randint(20, 200)):
+            if rng.random() < 0.3:
+                action = rng.randrange(10)
+            steering = (-30.0, -15.0, 0.0, 15.0, 30.0)[action % 5]
+            speed = (1.67, 3.33)[action // 5]
+            position = position + speed / 15.0
+            while True:
+                from_point = waypoints[waypoint]
+                to_point = waypoints[(waypoint + 1) % num_waypoints]
+                length = math.hypot(to_point[0] - from_point[0], to_point[1] - from_point[1])
+                if position <= length:
+                    break
+                position = position - length
+                waypoint = (waypoint + 1) % num_waypoints
+            heading = math.atan2(to_point[1] - from_point[1], to_point[0] - from_point[0])
+            offset = 0.1 * math.sin(steps / 10.0)
+            x = from_point[0] + position * math.cos(heading) - offset * math.sin(heading)
+            y = from_point[1] + position * math.sin(heading) + offset * math.cos(heading)
+            progress = progress + speed / 15.0 / 17.67 * 100
+            time = time + 0.0667
+            reward = 0.001 if abs(offset) > 0.09 else 35999.6
+            yield "SIM_TRACE_LOG:%d,%d,%.4f,%.4f,%.4f,%.1f,%.2f,%d,%.4f,%s,%s,%.4f,%d,%.2f,%.7f\n" % (
+                episode, steps, x, y, math.degrees(heading) + offset * 20, steering, speed, action, reward,
+                "False", "True", progress, waypoint, 17.67, time)
+
+
+class TraceArchiveTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.log_path = os.path.join(cls.directory.name, "training.log")
+        cls.archive_path = os.path.join(cls.directory.name, "training.dta")
+        with open(cls.log_path, "w") as f:
+            f.writelines(generate_trace_lines(300))
+        with open(cls.log_path) as f:
+            cls.rows = list(parse_trace_log(f))
+        write_archive(cls.archive_path, cls.rows)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def assertRowsEqual(self, columns, rows):
+        for index, (name, scale, order) in enumerate(COLUMNS):
+            self.assertEqual(len(columns[name]), len(rows))
+            for value, row in zip(columns[name], rows):
+                if not math.isfinite(row[index]):
+                    self.assertEqual(str(float(value)), str(row[index]))
+                else:
+                    self.assertAlmostEqual(value, row[index], delta=0.5 / scale + 1e-9 * abs(row[index]))
+
+    def test_parse_trace_line(self):
+        row = parse_trace_line("2019-08-26 SIM_TRACE_LOG:3,17,3.1820,0.6817,-0.0118,-15.0,1.33,2,35999.6000,False,"
+                               "True,8.5014,12,17.67,1566810937.3542686")
+        self.assertEqual(row[:4], (3, 17, 3.182, 0.6817))
+        self.assertEqual(row[COLUMN_INDEX["done"]], 0)
+        self.assertEqual(row[COLUMN_INDEX["all_wheels_on_track"]], 1)
+        self.assertEqual(row[COLUMN_INDEX["closest_waypoint_index"]], 12)
+        self.assertIsNone(parse_trace_line("SIM_TRACE_LOG:1,2,3"))
+        self.assertIsNone(parse_trace_line("Training> Episode 3 finished"))
+
+    def test_round_trip(self):
+        archive = TraceArchive(self.archive_path)
+        self.assertEqual(len(archive), len(self.rows))
+        self.assertEqual(archive.episodes(), list(range(300)))
+        self.assertRowsEqual(archive.read_all(), self.rows)
+
+    def test_read_episode(self):
+        archive = TraceArchive(self.archive_path)
+        columns = archive.read_episode(42)
+        self.assertRowsEqual(columns, [row for row in self.rows if row[0] == 42])
+        self.assertEqual(archive.read_episode(1000)["steps"], [])
+
+    def test_read_waypoints(self):
+        archive = TraceArchive(self.archive_path)
+        read_chunks = []
+        original_read_chunk = archive.read_chunk
+        archive.read_chunk = lambda chunk, f=None: read_chunks.append(chunk) or original_read_chunk(chunk, f)
+        columns = archive.read_waypoints(20, 30)
+        waypoint = COLUMN_INDEX["closest_waypoint_index"]
+        self.assertRowsEqual(columns, [row for row in self.rows if 20 <= row[waypoint] <= 30])
+        self.assertLess(len(read_chunks), len(archive.chunks))
+
+    def test_compression_ratio(self):
+        self.assertGreaterEqual(os.path.getsize(self.log_path), 10 * os.path.getsize(self.archive_path))
+
+    def test_non_finite_values(self):
+        lines = list(generate_trace_lines(3, seed=1))
+        for line_index, reward in ((5, "nan"), (6, "inf"), (40, "-inf")):
+            values = lines[line_index].split(",")
+            values[COLUMN_INDEX["reward"]] = reward
+            values[COLUMN_INDEX["heading"]] = reward
+            lines[line_index] = ",".join(values)
+        rows = list(parse_trace_log(lines))
+        path = os.path.join(self.directory.name, "anomalies.dta")
+        write_archive(path, rows)
+        columns = TraceArchive(path).read_all()
+        self.assertRowsEqual(columns, rows)
+        self.assertTrue(math.isnan(columns["reward"][5]))
+        self.assertEqual(columns["heading"][6], float("inf"))
+        self.assertEqual(columns["reward"][40], float("-inf"))
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_numpy_decoding(self):
+        archive = TraceArchive(self.archive_path)
+        numpy_archive = TraceArchive(self.archive_path, use_numpy=True)
+        expected = archive.read_all()
+        columns = numpy_archive.read_all()
+        for name in expected:
+            self.assertEqual(columns[name].tolist(), expected[name])
+        expected = archive.read_waypoints(20, 30)
+        columns = numpy_archive.read_waypoints(20, 30)
+        for name in expected:
+            self.assertEqual(columns[name].tolist(), expected[name])
+
+    def test_not_an_archive(self):
+        self.assertRaises(ValueError, TraceArchive, self.log_path)
+
+
+if __name__ == '__main__':
+    unittest.main()